@@ -0,0 +1,209 @@
+"""Load driver: đo docs/sec, p50/p95/p99 latency và peak RSS của server với mock Gemini.
+
+By default this starts bench/mock_gemini.py and server.py as subprocesses (caches disabled),
+generates a corpus if needed, then runs every mode x concurrency level:
+
+    python bench/load.py --modes standard material_list --concurrency 1 4 16 --requests 32
+
+Use --server-url (and optionally --server-pid for RSS) to drive an already running server.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from make_corpus import make_corpus  # noqa: E402
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_ready(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout}s")
+
+def rss_tree_kb(pid):
+    """RSS (KB) của process và toàn bộ process con (Linux /proc)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+            for tid in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{tid}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_kb = max(self.peak_kb, rss_tree_kb(self.pid))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak_kb
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+async def run_level(server_url, files, mode, concurrency, total_requests, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        async def one(i):
+            nonlocal errors
+            path = files[i % len(files)]
+            with open(path, "rb") as f:
+                body = f.read()
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(
+                        f"{server_url}/extract",
+                        files={"file": (os.path.basename(path), body)},
+                        data={"mode": mode},
+                    )
+                    if response.status_code != 200 or response.json().get("error"):
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total_requests)))
+        wall = time.perf_counter() - started
+
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": errors,
+        "docs_per_sec": round(total_requests / wall, 3),
+        "p50_s": round(percentile(latencies, 0.50), 3),
+        "p95_s": round(percentile(latencies, 0.95), 3),
+        "p99_s": round(percentile(latencies, 0.99), 3),
+    }
+
+def start_stack(args, workdir):
+    mock_port, server_port = free_port(), free_port()
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "mock_gemini.py"), "--port", str(mock_port),
+        "--latency-ms", str(args.latency_ms), "--sigma", str(args.sigma),
+        "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+    ])
+    env = dict(
+        os.environ,
+        API_KEY="bench",
+        GEMINI_API_BASE=f"http://127.0.0.1:{mock_port}/v1beta",
+        CACHE_ENABLED="1" if args.cache else "0",
+        CACHE_DB_PATH=os.path.join(workdir, "cache.sqlite3"),
+        JOBS_DB_PATH=os.path.join(workdir, "jobs.sqlite3"),
+        JOBS_SPOOL_DIR=os.path.join(workdir, "job_uploads"),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(server_port), "--log-level", "warning"],
+        cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    server_url = f"http://127.0.0.1:{server_port}"
+    wait_ready(f"http://127.0.0.1:{mock_port}/stats")
+    wait_ready(server_url + "/")
+    return mock, server, server_url
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load/latency benchmark for /extract")
+    parser.add_argument("--server-url", help="drive an existing server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of --server-url process (for peak RSS)")
+    parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus"))
+    parser.add_argument("--modes", nargs="*", default=["standard", "material_list"])
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=16, help="requests per mode x concurrency level")
+    parser.add_argument("--timeout", type=float, default=900)
+    parser.add_argument("--latency-ms", type=float, default=1500.0)
+    parser.add_argument("--sigma", type=float, default=0.4)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--cache", action="store_true", help="keep server result/page caches enabled")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    files = sorted(
+        os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+    ) if os.path.isdir(args.corpus) else make_corpus(args.corpus)
+
+    processes = []
+    workdir = tempfile.mkdtemp(prefix="extractor-bench-")
+    if args.server_url:
+        server_url, server_pid = args.server_url.rstrip("/"), args.server_pid
+    else:
+        mock, server, server_url = start_stack(args, workdir)
+        processes = [server, mock]
+        server_pid = server.pid
+
+    results = []
+    try:
+        for mode in args.modes:
+            mode_files = [f for f in files if f.lower().endswith(".pdf")] if mode == "material_list" else files
+            for concurrency in args.concurrency:
+                sampler = RssSampler(server_pid) if server_pid else None
+                if sampler:
+                    sampler.start()
+                result = asyncio.run(run_level(server_url, mode_files, mode, concurrency, args.requests, args.timeout))
+                result["peak_rss_mb"] = round(sampler.stop() / 1024, 1) if sampler else None
+                results.append(result)
+                print(
+                    f"{mode:<14} c={concurrency:<3} {result['docs_per_sec']:>7} docs/s  "
+                    f"p50={result['p50_s']}s p95={result['p95_s']}s p99={result['p99_s']}s  "
+                    f"errors={result['errors']}  peak_rss={result['peak_rss_mb']}MB"
+                )
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
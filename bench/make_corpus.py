@@ -0,0 +1,86 @@
+"""Sinh bộ dữ liệu tổng hợp (PDF nhiều trang + ảnh nhiều kích thước) cho benchmark.
+
+Usage:
+    python bench/make_corpus.py --out bench/corpus --pdf-pages 1 5 20 --image-sizes 1200 2400 4000
+"""
+import argparse
+import io
+import os
+import random
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+def draw_form_page(page, page_index, rows=25):
+    """Vẽ một trang giống phiếu kho: tiêu đề, bảng có kẻ ô và chữ"""
+    width = page.rect.width
+    page.insert_text((180, 60), "PHIEU NHAP KHO", fontsize=18)
+    page.insert_text((200, 85), f"Ngay 14 thang 07 nam 2022 - So: NK{page_index:05d}", fontsize=10)
+    top, row_h = 120, 24
+    columns = [40, 70, 300, 360, 420, 480, width - 40]
+    for r in range(rows + 1):
+        y = top + r * row_h
+        page.draw_line((columns[0], y), (columns[-1], y))
+    for x in columns:
+        page.draw_line((x, top), (x, top + rows * row_h))
+    for r in range(rows):
+        y = top + r * row_h + 16
+        page.insert_text((columns[0] + 4, y), str(r + 1), fontsize=9)
+        page.insert_text((columns[1] + 4, y), f"Vat tu {random.randint(100, 999)} 25B{random.randint(100, 999)}", fontsize=9)
+        page.insert_text((columns[2] + 4, y), "Cai", fontsize=9)
+        page.insert_text((columns[3] + 4, y), str(random.randint(1, 20)), fontsize=9)
+        page.insert_text((columns[4] + 4, y), str(random.randint(1000, 99999)), fontsize=9)
+
+def make_pdf(path, pages, scanned=False):
+    """scanned=True: mỗi trang là ảnh raster (giống file scan), nặng hơn nhiều so với PDF vector"""
+    doc = fitz.open()
+    for i in range(pages):
+        draw_form_page(doc.new_page(width=595, height=842), i)
+    if scanned:
+        scan = fitz.open()
+        for page in doc:
+            jpeg = page.get_pixmap(dpi=150).tobytes("jpeg", jpg_quality=80)
+            scan.new_page(width=595, height=842).insert_image(fitz.Rect(0, 0, 595, 842), stream=jpeg)
+        doc = scan
+    doc.save(path, garbage=3, deflate=True)
+
+def make_image(path, size):
+    """Ảnh chụp phiếu kích thước `size` (cạnh dài) với nhiễu nhẹ"""
+    image = Image.new("RGB", (size, int(size * 1.414)), "white")
+    draw = ImageDraw.Draw(image)
+    step = max(size // 40, 8)
+    for y in range(step * 4, image.height - step, step):
+        draw.line((step, y, image.width - step, y), fill=(40, 40, 40), width=max(size // 1000, 1))
+        draw.text((step * 2, y - step + 2), f"Vat tu {random.randint(100, 999)}", fill=(0, 0, 0))
+    for _ in range(size * 4):
+        draw.point((random.randrange(image.width), random.randrange(image.height)), fill=(200, 200, 200))
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=90)
+    with open(path, "wb") as f:
+        f.write(buffered.getvalue())
+
+def make_corpus(out_dir, pdf_pages=(1, 5, 20), image_sizes=(1200, 2400, 4000), scanned=True, seed=0):
+    random.seed(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for pages in pdf_pages:
+        path = os.path.join(out_dir, f"form_{pages}p{'_scan' if scanned else ''}.pdf")
+        make_pdf(path, pages, scanned=scanned)
+        paths.append(path)
+    for size in image_sizes:
+        path = os.path.join(out_dir, f"photo_{size}.jpg")
+        make_image(path, size)
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic benchmark corpus")
+    parser.add_argument("--out", default=os.path.join(os.path.dirname(__file__), "corpus"))
+    parser.add_argument("--pdf-pages", type=int, nargs="*", default=[1, 5, 20])
+    parser.add_argument("--image-sizes", type=int, nargs="*", default=[1200, 2400, 4000])
+    parser.add_argument("--vector", action="store_true", help="vector PDFs instead of scanned (raster) pages")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for path in make_corpus(args.out, args.pdf_pages, args.image_sizes, not args.vector, args.seed):
+        print(f"{path} ({os.path.getsize(path) / 1024:.0f} KB)")
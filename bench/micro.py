@@ -0,0 +1,78 @@
+"""Microbenchmarks cho các hàm xử lý cục bộ (không gọi Gemini).
+
+Usage:
+    python bench/micro.py [--corpus bench/corpus] [--rows 2000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+# Import server without touching the working directory (cache / job databases go to a temp dir)
+_workdir = tempfile.mkdtemp(prefix="extractor-micro-")
+os.environ.setdefault("API_KEY", "bench")
+os.environ.setdefault("CACHE_ENABLED", "0")
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(_workdir, "jobs.sqlite3"))
+os.environ.setdefault("JOBS_SPOOL_DIR", os.path.join(_workdir, "job_uploads"))
+
+import server  # noqa: E402
+from make_corpus import make_pdf  # noqa: E402
+from mock_gemini import STANDARD_ROWS, material_csv  # noqa: E402
+
+def bench(name, fn, number, repeat):
+    best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+    print(f"{name:<40} {best * 1000:>10.3f} ms/call")
+    return name, best
+
+def export_rows(export_format, rows):
+    """Ghi toàn bộ dòng qua exporter (không giữ output, giống StreamingResponse)"""
+    exporter = server.new_export(export_format, "standard")
+    server.write_export_rows(exporter, rows)
+    return exporter.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for local processing functions")
+    parser.add_argument("--pages", type=int, default=5, help="pages in the synthetic scanned PDF")
+    parser.add_argument("--rows", type=int, default=2000, help="rows for parse/flatten benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    pdf_path = os.path.join(_workdir, "micro.pdf")
+    make_pdf(pdf_path, args.pages, scanned=True)
+
+    csv_text = material_csv(args.rows)
+    items = [dict(row) for _ in range(args.rows // len(STANDARD_ROWS)) for row in STANDARD_ROWS]
+    items_json = json.dumps(items)
+    export_values = server.standard_export_rows(server.flatten_data(json.loads(items_json)), "micro.pdf")
+    order_texts = ["25B827, 828, 621", "25B834-838", "26D 486-->489, 495", "22A023"] * (args.rows // 4)
+
+    results = [
+        # Đường render thật của worker process: render + triage features + encode + base64, từng trang
+        *(bench(f"render_pdf_page_part {profile} ({args.pages} pages)",
+                lambda profile=profile: [server.render_pdf_page_part(pdf_path, index, profile)
+                                         for index in range(args.pages)], 1, args.repeat)
+          for profile in ("jpeg", "auto")),
+        bench(f"parse_material_csv ({args.rows} rows)", lambda: server.parse_material_csv(csv_text), 1, args.repeat),
+        # flatten_data mutates its input, so every call gets a fresh copy
+        bench(f"flatten_data ({len(items)} items)", lambda: server.flatten_data(json.loads(items_json)), 1, args.repeat),
+        bench(f"json.loads ({len(items)} items)", lambda: json.loads(items_json), 1, args.repeat),
+        bench(f"expand_order_numbers ({len(order_texts)} cells)",
+              lambda: [server.expand_order_numbers(text) for text in order_texts], 1, args.repeat),
+        bench(f"export csv ({len(export_values)} rows)", lambda: export_rows("csv", export_values), 1, args.repeat),
+        bench(f"export xlsx ({len(export_values)} rows)", lambda: export_rows("xlsx", export_values), 1, args.repeat),
+    ]
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({name: seconds for name, seconds in results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Local stand-in for the Gemini `generateContent` endpoint (không tốn API quota).
+
+Usage:
+    python bench/mock_gemini.py --port 8100 --latency-ms 1500 --sigma 0.4 --error-rate 0.02
+
+Then start the server with GEMINI_API_BASE=http://127.0.0.1:8100/v1beta
+(add GEMINI_STREAMING=1 to exercise streamGenerateContent / SSE)
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+import argparse
+import asyncio
+import json
+import math
+import random
+
+# Canned responses: JSON array for Standard Mode, pipe-separated CSV for Material List Mode
+STANDARD_ROWS = [
+    {
+        "doc_type": "Import",
+        "date": "14/07/2022",
+        "id": "NK00123",
+        "name": "Công ty Điện lực",
+        "description": "Sứ cao thế mới 35/250- CD 965 Đông Hải",
+        "order_numbers": ["25B834", "25B835", "25B836"],
+        "code": "VT001",
+        "unit": "Cái",
+        "quantity_doc": 3,
+        "quantity_actual": 3,
+        "unitprice": 500000,
+        "totalprice": 1500000
+    },
+    {
+        "doc_type": "Import",
+        "date": "14/07/2022",
+        "id": "NK00123",
+        "name": "Công ty Điện lực",
+        "description": "Điều chỉnh dưới tải CVIII-350Y/40.5-14271W",
+        "order_numbers": [],
+        "code": "VT002",
+        "unit": "Bộ",
+        "quantity_doc": 1,
+        "quantity_actual": None,
+        "unitprice": 12000000,
+        "totalprice": 12000000
+    }
+]
+
+MATERIAL_HEADER = "Tên bảng|Mã code|STT|Tên vật tư|Quy cách|ĐVT|Định mức|Thực lĩnh|Chênh lệch|Ghi chú"
+
+def material_csv(rows):
+    lines = [MATERIAL_HEADER, "BẢNG KÊ VẬT TƯ MOF|27B123|A|TÔN SILIC||||||"]
+    for i in range(1, rows + 1):
+        lines.append(f"BẢNG KÊ VẬT TƯ MOF|27B123|{i}|Tôn TU {i}|45 x 0.27|Kg|{i}+1|{i + 1}||")
+    return "\n".join(lines)
+
+def sse_chunks(text, delay, pieces=20):
+    """streamGenerateContent?alt=sse: text chia thành nhiều event, 30% latency trước event đầu tiên"""
+    size = max(len(text) // pieces, 1)
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def events():
+        await asyncio.sleep(delay * 0.3)
+        for chunk in chunks:
+            body = {"candidates": [{"content": {"parts": [{"text": chunk}], "role": "model"}}]}
+            yield f"data: {json.dumps(body, ensure_ascii=False)}\r\n\r\n"
+            await asyncio.sleep(delay * 0.7 / len(chunks))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def create_app(latency_ms=1500.0, sigma=0.4, error_rate=0.0, rate_limit_rate=0.0, material_rows=40):
+    """latency: lognormal với median `latency_ms`; lỗi 503 theo `error_rate`, 429 theo `rate_limit_rate`"""
+    app = FastAPI()
+    app.state.calls = 0
+
+    @app.post("/v1beta/models/{model_action}")
+    async def generate_content(model_action: str, request: Request):
+        app.state.calls += 1
+        payload = await request.json()
+        delay = latency_ms / 1000.0 * math.exp(random.gauss(0, sigma)) if sigma > 0 else latency_ms / 1000.0
+
+        roll = random.random()
+        streaming = model_action.endswith(":streamGenerateContent")
+        if roll < rate_limit_rate:
+            return JSONResponse({"error": {"code": 429, "message": "Resource exhausted"}},
+                                status_code=429, headers={"Retry-After": "1"})
+        if not streaming:
+            await asyncio.sleep(delay)
+        if roll < rate_limit_rate + error_rate:
+            return JSONResponse({"error": {"code": 503, "message": "Service unavailable"}}, status_code=503)
+
+        mime = payload.get("generationConfig", {}).get("response_mime_type", "text/plain")
+        images = sum(1 for part in payload["contents"][0]["parts"] if "inline_data" in part)
+        if mime != "application/json":
+            text = material_csv(material_rows)
+        elif images > 1:
+            # Packed request (PACK_PAGES > 1): rows của mọi ảnh, gắn field "page"
+            text = json.dumps([dict(row, page=n) for n in range(1, images + 1) for row in STANDARD_ROWS], ensure_ascii=False)
+        else:
+            text = json.dumps(STANDARD_ROWS, ensure_ascii=False)
+        if streaming:
+            return sse_chunks(text, delay)
+        return {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}}]}
+
+    @app.get("/stats")
+    def stats():
+        return {"calls": app.state.calls}
+
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Gemini generateContent server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=1500.0, help="median latency")
+    parser.add_argument("--sigma", type=float, default=0.4, help="lognormal sigma (0 = fixed latency)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--material-rows", type=int, default=40)
+    args = parser.parse_args()
+
+    app = create_app(args.latency_ms, args.sigma, args.error_rate, args.rate_limit_rate, args.material_rows)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
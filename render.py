@@ -0,0 +1,227 @@
+"""Render / encode / triage trang PDF và ảnh upload.
+
+Các hàm ở đây chạy trong process pool (server.run_cpu_bound): module không có side effect khi import
+(không tạo app, cache hay job store), nên worker process chỉ import module này.
+"""
+import base64
+import io
+import os
+from collections import OrderedDict
+
+import fitz  # PyMuPDF: Dùng để xử lý PDF
+from PIL import Image
+
+# --- CONFIGURATION ---
+# Đọc từ môi trường của process cha (server đã load_dotenv trước khi import module này)
+
+# Rasterization: render scale is picked up front so each page is encoded only once. Memory is bounded by
+# PAGE_CONCURRENCY / RENDER_QUEUE_DEPTH and the upload byte budget, so DPI is purely a quality/cost knob.
+RENDER_DPI = int(os.getenv("RENDER_DPI", "200"))
+MAX_SIZE = int(os.getenv("MAX_SIZE", "3072"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+
+# Image encoding budgets / thresholds used by the non-"jpeg" profiles (see ENCODING_PROFILE in server.py)
+ENCODING_PROFILES = ("jpeg", "gray_jpeg", "gray_webp", "bilevel_png", "auto")
+ENCODING_MAX_PIXELS = int(os.getenv("ENCODING_MAX_PIXELS", str(4_000_000)))
+ENCODING_MAX_BYTES = int(os.getenv("ENCODING_MAX_BYTES", str(600 * 1024)))
+ENCODING_WEBP_QUALITY = int(os.getenv("ENCODING_WEBP_QUALITY", "80"))
+ENCODING_COLOR_THRESHOLD = float(os.getenv("ENCODING_COLOR_THRESHOLD", "6.0"))  # mean |R-G|+|G-B| below = gray
+ENCODING_BILEVEL_MIDTONES = float(os.getenv("ENCODING_BILEVEL_MIDTONES", "0.02"))  # mid-gray fraction below = bilevel
+
+# Page triage features (blank / duplicate decisions are made by server.py)
+TRIAGE_ENABLED = os.getenv("TRIAGE_ENABLED", "1") == "1"
+TRIAGE_INK_LEVEL = int(os.getenv("TRIAGE_INK_LEVEL", "160"))              # gray value below = ink
+TRIAGE_MARGIN = float(os.getenv("TRIAGE_MARGIN", "0.03"))                 # ignore scanner edges
+
+# --- RENDER / ENCODE ---
+
+def make_inline_part(data_bytes, mime_type):
+    return {
+        "inline_data": {
+            "mime_type": mime_type,
+            "data": base64.b64encode(data_bytes).decode("utf-8")
+        }
+    }
+
+def render_page_pixmap(page):
+    """Render một trang PDF, scale chọn trước theo MAX_SIZE (không cần resize lại sau đó)"""
+    longest_side_pt = max(page.rect.width, page.rect.height) or 1
+    zoom = min(RENDER_DPI / 72, MAX_SIZE / longest_side_pt)
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+def page_features(pix):
+    """Đặc trưng rẻ để phân loại trang: tỉ lệ mực, độ lệch chuẩn mức xám, dHash 4096 bit"""
+    gray = pix if pix.n == 1 else fitz.Pixmap(fitz.csGRAY, pix)
+    image = Image.frombytes("L", (gray.width, gray.height), gray.samples)
+    mx, my = int(image.width * TRIAGE_MARGIN), int(image.height * TRIAGE_MARGIN)
+    image = image.crop((mx, my, image.width - mx, image.height - my))
+
+    histogram = image.histogram()
+    total = sum(histogram) or 1
+    mean = sum(level * count for level, count in enumerate(histogram)) / total
+    variance = sum(count * (level - mean) ** 2 for level, count in enumerate(histogram)) / total
+
+    # dHash: so sánh độ sáng các ô kề nhau trên ảnh thu nhỏ 65x64
+    small = image.resize((65, 64), Image.Resampling.BOX).tobytes()
+    dhash = 0
+    for row in range(64):
+        for col in range(64):
+            dhash = (dhash << 1) | (small[row * 65 + col] > small[row * 65 + col + 1])
+
+    return {
+        "ink_ratio": sum(histogram[:TRIAGE_INK_LEVEL]) / total,
+        "stddev": variance ** 0.5,
+        "dhash": dhash,
+    }
+
+def pdf_page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+# Mỗi worker process giữ lại vài tài liệu đang mở để không phải parse lại PDF cho từng trang
+_worker_docs = OrderedDict()  # (path, inode, size) -> tài liệu fitz đang mở trong worker process
+_WORKER_DOCS_MAX = 2
+
+def _worker_doc(pdf_path):
+    """Tài liệu đang mở của file spool; đóng các tài liệu có file đã bị xóa / thay thế để không giữ
+    dung lượng đĩa của upload đã xong"""
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_ino, stat.st_size)
+    for old_key in list(_worker_docs):
+        if old_key == key:
+            continue
+        try:
+            old_stat = os.stat(old_key[0])
+            stale = (old_stat.st_ino, old_stat.st_size) != old_key[1:]
+        except FileNotFoundError:
+            stale = True
+        if stale:
+            _worker_docs.pop(old_key).close()
+    doc = _worker_docs.get(key)
+    if doc is None:
+        doc = fitz.open(pdf_path)
+        _worker_docs[key] = doc
+        while len(_worker_docs) > _WORKER_DOCS_MAX:
+            _, old_doc = _worker_docs.popitem(last=False)
+            old_doc.close()
+    else:
+        _worker_docs.move_to_end(key)
+    return doc
+
+def render_pdf_page_part(pdf_path, page_index, profile="jpeg"):
+    """Chạy trong worker process: render + encode + base64 một trang.
+    Trả về (inline part, features, encoding info) — features là None khi tắt triage"""
+    doc = _worker_doc(pdf_path)
+    pix = render_page_pixmap(doc[page_index])
+    features = page_features(pix) if TRIAGE_ENABLED else None
+    if profile == "jpeg":
+        # Đường nhanh: PyMuPDF encode JPEG trực tiếp, không qua PIL
+        data, mime = pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY), "image/jpeg"
+        info = {"profile": profile, "format": "jpeg", "bytes": len(data), "width": pix.width, "height": pix.height}
+    else:
+        data, mime, info = encode_page_image(Image.frombytes("RGB", (pix.width, pix.height), pix.samples), profile)
+    return make_inline_part(data, mime), features, info
+
+def _save_image(image, fmt, **params):
+    buffered = io.BytesIO()
+    image.save(buffered, format=fmt, **params)
+    return buffered.getvalue()
+
+def _content_crop(gray):
+    """Cắt lề trắng quanh vùng có mực (giữ đệm 2%) — bảng/chữ vẫn nguyên vẹn"""
+    mask = gray.point(lambda v: 255 if v < TRIAGE_INK_LEVEL else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    pad_x, pad_y = int(gray.width * 0.02), int(gray.height * 0.02)
+    return (max(bbox[0] - pad_x, 0), max(bbox[1] - pad_y, 0),
+            min(bbox[2] + pad_x, gray.width), min(bbox[3] + pad_y, gray.height))
+
+def _encode_candidates(image, profile):
+    """Trả về list (bytes, mime, format) cho profile trên ảnh đã crop/scale"""
+    if profile == "gray_jpeg":
+        return [(_save_image(image.convert("L"), "JPEG", quality=JPEG_QUALITY), "image/jpeg", "jpeg")]
+    if profile == "gray_webp":
+        return [(_save_image(image.convert("L"), "WEBP", quality=ENCODING_WEBP_QUALITY), "image/webp", "webp")]
+    if profile == "bilevel_png":
+        bilevel = image.convert("L").point(lambda v: 255 if v >= TRIAGE_INK_LEVEL else 0).convert("1")
+        return [(_save_image(bilevel, "PNG", optimize=True), "image/png", "png")]
+
+    # auto: chọn grayscale khi ảnh gần như không màu, bilevel khi gần như không có tông xám trung gian
+    small = image.convert("RGB").reduce(8) if min(image.size) >= 64 else image.convert("RGB")
+    r, g, b = (channel.tobytes() for channel in small.split())
+    colorfulness = sum(abs(r[i] - g[i]) + abs(g[i] - b[i]) for i in range(len(r))) / max(len(r), 1)
+    if colorfulness >= ENCODING_COLOR_THRESHOLD:
+        rgb = image.convert("RGB")
+        return [
+            (_save_image(rgb, "JPEG", quality=JPEG_QUALITY), "image/jpeg", "jpeg"),
+            (_save_image(rgb, "WEBP", quality=ENCODING_WEBP_QUALITY), "image/webp", "webp"),
+        ]
+    candidates = _encode_candidates(image, "gray_jpeg") + _encode_candidates(image, "gray_webp")
+    histogram = image.convert("L").histogram()
+    midtones = sum(histogram[64:192]) / (sum(histogram) or 1)
+    if midtones < ENCODING_BILEVEL_MIDTONES:
+        candidates += _encode_candidates(image, "bilevel_png")
+    return candidates
+
+def encode_page_image(image, profile):
+    """Encode một ảnh trang theo profile, trả về (bytes, mime, info) — info ghi lại kích thước payload"""
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile}")
+    if image.mode in ("RGBA", "P", "CMYK", "LA"):
+        image = image.convert("RGB")
+
+    if max(image.size) > MAX_SIZE:
+        image.thumbnail((MAX_SIZE, MAX_SIZE))
+
+    if profile == "jpeg":
+        data = _save_image(image, "JPEG", quality=JPEG_QUALITY)
+        return data, "image/jpeg", {"profile": profile, "format": "jpeg", "bytes": len(data),
+                                    "width": image.width, "height": image.height}
+
+    crop = _content_crop(image.convert("L"))
+    if crop is not None:
+        image = image.crop(crop)
+    pixels = image.width * image.height
+    if pixels > ENCODING_MAX_PIXELS:
+        scale = (ENCODING_MAX_PIXELS / pixels) ** 0.5
+        image = image.resize((max(int(image.width * scale), 1), max(int(image.height * scale), 1)), Image.Resampling.LANCZOS)
+
+    while True:
+        data, mime, fmt = min(_encode_candidates(image, profile), key=lambda c: len(c[0]))
+        # auto: thu nhỏ dần tới khi vừa ENCODING_MAX_BYTES (không nhỏ hơn 1000px cạnh dài)
+        if profile != "auto" or len(data) <= ENCODING_MAX_BYTES or max(image.size) * 0.85 < 1000:
+            break
+        image = image.resize((int(image.width * 0.85), int(image.height * 0.85)), Image.Resampling.LANCZOS)
+
+    return data, mime, {"profile": profile, "format": fmt, "bytes": len(data),
+                        "width": image.width, "height": image.height}
+
+def encode_image(image_path, filename, profile="jpeg"):
+    """Chuẩn hóa ảnh upload trực tiếp theo encoding profile, trả về (inline part, info)"""
+    try:
+        with Image.open(image_path) as image:
+            data, mime, info = encode_page_image(image, profile)
+        return make_inline_part(data, mime), info
+    except Exception:
+        # Fallback to direct bytes
+        with open(image_path, "rb") as f:
+            file_bytes = f.read()
+        mime = "image/png" if filename.lower().endswith(".png") else "image/jpeg"
+        return make_inline_part(file_bytes, mime), {"profile": "raw", "format": mime.split("/")[1],
+                                                    "bytes": len(file_bytes)}
+
+def split_pdf_chunks(pdf_path, chunk_pages, out_dir):
+    """Tách PDF thành các PDF con trong out_dir, mỗi file tối đa `chunk_pages` trang (giữ thứ tự trang).
+    Trả về list path; PDF đủ nhỏ được dùng nguyên file gốc"""
+    with fitz.open(pdf_path) as doc:
+        if chunk_pages <= 0 or doc.page_count <= chunk_pages:
+            return [pdf_path]
+        chunks = []
+        for start in range(0, doc.page_count, chunk_pages):
+            with fitz.open() as chunk:
+                chunk.insert_pdf(doc, from_page=start, to_page=min(start + chunk_pages, doc.page_count) - 1)
+                path = os.path.join(out_dir, f"chunk_{len(chunks)}.pdf")
+                chunk.save(path, garbage=3, deflate=True)
+                chunks.append(path)
+        return chunks
@@ -1,28 +1,49 @@
+from typing import List
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from starlette.background import BackgroundTask
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
+import asyncio
 import base64
+import csv
 import json
-import requests
+import math
+import re
+import httpx
 import io
-import fitz  # PyMuPDF: Dùng để xử lý PDF
 import os
-import concurrent.futures
-from PIL import Image
+import hashlib
+import sqlite3
+import threading
+import time
+import random
+import tempfile
+import uuid
+import copy
+import zipfile
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, aclosing, contextmanager
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+from xml.sax.saxutils import escape as xml_escape
 from dotenv import load_dotenv
 
-# Initialize FastAPI
-app = FastAPI()
+try:
+    import h2  # noqa: F401  (optional: enables HTTP/2 multiplexing in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 load_dotenv()
 
-# CORS Configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# Render / encode chạy trong worker process: module riêng, không có side effect khi import
+# (import sau load_dotenv vì render.py đọc cấu hình từ môi trường)
+from render import (  # noqa: E402
+    ENCODING_PROFILES, encode_image, pdf_page_count, render_pdf_page_part, split_pdf_chunks,
 )
 
 # --- CONFIGURATION ---
@@ -31,8 +52,131 @@ if not API_KEY:
     print("WARNING: API_KEY not found in environment variables.")
 
 # Define endpoints for different models
-GEMINI_URL_FLASH = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent?key={API_KEY}"
-GEMINI_URL_PRO = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro:generateContent?key={API_KEY}"
+GEMINI_MODEL_FLASH = os.getenv("GEMINI_MODEL_FLASH", "gemini-3-flash-preview")
+GEMINI_MODEL_PRO = os.getenv("GEMINI_MODEL_PRO", "gemini-2.5-pro")
+# GEMINI_API_BASE can point at a local stand-in (e.g. bench/mock_gemini.py); GEMINI_URL_* override one model
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+GEMINI_URL_FLASH = os.getenv(
+    "GEMINI_URL_FLASH", f"{GEMINI_API_BASE}/models/{GEMINI_MODEL_FLASH}:generateContent?key={API_KEY}"
+)
+GEMINI_URL_PRO = os.getenv(
+    "GEMINI_URL_PRO", f"{GEMINI_API_BASE}/models/{GEMINI_MODEL_PRO}:generateContent?key={API_KEY}"
+)
+
+# HTTP connection pool shared by every Gemini call (keep-alive, HTTP/2 when `h2` is installed)
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "64"))
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "32"))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "10"))
+GEMINI_TIMEOUT_FLASH = float(os.getenv("GEMINI_TIMEOUT_FLASH", "120"))
+GEMINI_TIMEOUT_PRO = float(os.getenv("GEMINI_TIMEOUT_PRO", "600"))
+# Server-wide scheduler: global in-flight cap + per-model token buckets (requests/minute, burst)
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "16"))
+GEMINI_RPM_FLASH = float(os.getenv("GEMINI_RPM_FLASH", "300"))
+GEMINI_BURST_FLASH = int(os.getenv("GEMINI_BURST_FLASH", "10"))
+GEMINI_RPM_PRO = float(os.getenv("GEMINI_RPM_PRO", "60"))
+GEMINI_BURST_PRO = int(os.getenv("GEMINI_BURST_PRO", "5"))
+# Resilience: retries with jittered exponential backoff (honors Retry-After) + optional hedging
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+GEMINI_RETRY_AFTER_MAX = float(os.getenv("GEMINI_RETRY_AFTER_MAX", "60"))
+GEMINI_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "0") == "1"
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0.95"))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+GEMINI_LATENCY_WINDOW = int(os.getenv("GEMINI_LATENCY_WINDOW", "200"))
+# Streaming generation (streamGenerateContent, SSE): output is parsed incrementally, rows are previewed on
+# /extract/stream and a response is cancelled as soon as it is clearly malformed.
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "0") == "1"
+GEMINI_STREAM_MAX_PREAMBLE = int(os.getenv("GEMINI_STREAM_MAX_PREAMBLE", "2048"))  # junk chars before data
+
+# Model router: each mode prefers its model (standard -> Flash, material_list -> Pro) and falls back to the
+# other one when the preferred model's circuit is open, its recent latency cannot meet the request deadline,
+# or its call fails with a retryable error. Deadlines come from the "deadline" (seconds) or "slo" form field.
+ROUTER_FALLBACK_ENABLED = os.getenv("ROUTER_FALLBACK_ENABLED", "1") == "1"
+ROUTER_LATENCY_PERCENTILE = float(os.getenv("ROUTER_LATENCY_PERCENTILE", "0.9"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "10"))
+ROUTER_ERROR_WINDOW = int(os.getenv("ROUTER_ERROR_WINDOW", "50"))              # last N attempts per model
+ROUTER_BREAKER_ERROR_RATE = float(os.getenv("ROUTER_BREAKER_ERROR_RATE", "0.5"))
+ROUTER_BREAKER_MIN_CALLS = int(os.getenv("ROUTER_BREAKER_MIN_CALLS", "10"))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30"))
+# SLO tiers -> deadline in seconds ("batch" = no deadline)
+SLO_TIERS = {
+    "interactive": float(os.getenv("SLO_INTERACTIVE_SECONDS", "60")),
+    "standard": float(os.getenv("SLO_STANDARD_SECONDS", "300")),
+    "batch": None,
+}
+# Số trang Standard Mode gửi song song cho mỗi request
+PAGE_CONCURRENCY = int(os.getenv("PAGE_CONCURRENCY", "4"))
+
+# Background jobs: durable SQLite queue for large batches / slow material lists
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.sqlite3")
+JOBS_SPOOL_DIR = os.getenv("JOBS_SPOOL_DIR", "job_uploads")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", str(7 * 24 * 3600)))
+# Several server processes may share the queue: each claim records its owner and is refreshed every
+# JOB_HEARTBEAT_SECONDS; a claim without a heartbeat for JOB_CLAIM_STALE_SECONDS is put back in the queue.
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_CLAIM_STALE_SECONDS = float(os.getenv("JOB_CLAIM_STALE_SECONDS", "180"))
+
+# Uploads: copied to disk in chunks (never read whole into RAM) and admitted against a global budget of
+# upload bytes in flight. A request that does not fit waits up to INFLIGHT_QUEUE_SECONDS, then gets 503.
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+INFLIGHT_MAX_BYTES = int(os.getenv("INFLIGHT_MAX_BYTES", str(512 * 1024 * 1024)))
+INFLIGHT_QUEUE_SECONDS = float(os.getenv("INFLIGHT_QUEUE_SECONDS", "10"))
+
+# Standard mode packing: send up to PACK_PAGES pages per request (1 = off), flushing early once the
+# encoded pages of a pack exceed PACK_MAX_BYTES. A failed pack falls back to per-page calls.
+PACK_PAGES = int(os.getenv("PACK_PAGES", "1"))
+PACK_MAX_BYTES = int(os.getenv("PACK_MAX_BYTES", str(6 * 1024 * 1024)))
+
+# Exports (CSV / XLSX): rows are written as pages / job files complete and sent to the client in chunks of
+# about EXPORT_FLUSH_BYTES, so an export never holds the whole file in memory.
+EXPORT_FLUSH_BYTES = int(os.getenv("EXPORT_FLUSH_BYTES", str(64 * 1024)))
+# Standard Mode exports only keep rows for the result cache up to this many; larger exports skip the cache write.
+EXPORT_CACHE_MAX_ROWS = int(os.getenv("EXPORT_CACHE_MAX_ROWS", "5000"))
+
+# Order numbers: "server" = model trả về text gốc ("25B834-838"), server tự mở rộng prefix/range;
+# "model" = prompt cũ, model tự liệt kê mảng đầy đủ (server giữ nguyên mảng đó).
+ORDER_NUMBER_EXPANSION = os.getenv("ORDER_NUMBER_EXPANSION", "server")
+ORDER_RANGE_MAX_SPAN = int(os.getenv("ORDER_RANGE_MAX_SPAN", "500"))   # range rộng hơn -> giữ nguyên text
+ORDER_NUMBERS_MAX = int(os.getenv("ORDER_NUMBERS_MAX", "2000"))        # tối đa mã sau khi mở rộng / dòng
+
+# Material list: split PDFs into chunks of N pages extracted in parallel (0 = one call for the whole PDF)
+MATERIAL_CHUNK_PAGES = int(os.getenv("MATERIAL_CHUNK_PAGES", "5"))
+
+# Image encoding profile per page: "jpeg" (RGB JPEG, legacy), "gray_jpeg", "gray_webp",
+# "bilevel_png" or "auto" (picks grayscale/bilevel/WebP, crops margins, fits the budgets in render.py).
+# Render / encode / triage-feature settings (RENDER_DPI, MAX_SIZE, ENCODING_*, TRIAGE_INK_LEVEL, ...) are read in render.py.
+ENCODING_PROFILE = os.getenv("ENCODING_PROFILE", "jpeg")
+
+# Page triage (Standard Mode PDFs): skip near-blank pages, detect exact / near-duplicate pages
+# A page is blank only when BOTH its ink fraction and its gray stddev are below the thresholds
+# (a page with a single header line measures ink_ratio ~0.0015)
+TRIAGE_BLANK_INK_RATIO = float(os.getenv("TRIAGE_BLANK_INK_RATIO", "0.0003"))
+TRIAGE_BLANK_STDDEV = float(os.getenv("TRIAGE_BLANK_STDDEV", "4.0"))
+# Near-duplicates: max Hamming distance of the 4096-bit dHash, -1 = off. Off by default because pages
+# printed from the same form template differ by only a few bits; exact duplicates are always detected.
+TRIAGE_DUP_MAX_DISTANCE = int(os.getenv("TRIAGE_DUP_MAX_DISTANCE", "-1"))
+TRIAGE_DUPLICATE_ACTION = os.getenv("TRIAGE_DUPLICATE_ACTION", "reuse")   # "reuse" rows or "drop" page
+
+# Tracing: print every per-request / per-page span (a custom hook can be set with set_trace_hook)
+TRACE_SPANS = os.getenv("TRACE_SPANS", "0") == "1"
+
+# Process pool for CPU-bound rendering / encoding (0 = run in a thread instead)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+# Max render/encode jobs queued or running in the pool across all requests
+RENDER_QUEUE_DEPTH = int(os.getenv("RENDER_QUEUE_DEPTH", str(max(RENDER_WORKERS, 1) * 2)))
+
+# Result cache: in-memory LRU (bounded by bytes) + SQLite tier that survives restarts
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_MEMORY_MAX_BYTES = int(os.getenv("CACHE_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "extraction_cache.sqlite3")
+CACHE_DISK_MAX_ENTRIES = int(os.getenv("CACHE_DISK_MAX_ENTRIES", "5000"))
+# Page cache: per-page Standard Mode results keyed by the rendered page content
+PAGE_CACHE_MEMORY_MAX_BYTES = int(os.getenv("PAGE_CACHE_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+PAGE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_DISK_MAX_ENTRIES", "50000"))
 
 # --- PROMPTS ---
 
@@ -106,6 +250,33 @@ Return ONLY a raw JSON Array. Do not include markdown blocks like ```json.
 ]
 """
 
+# STANDARD_PROMPT variant (ORDER_NUMBER_EXPANSION=server): model chỉ chép lại text mã số, server tự mở rộng
+_ORDER_RULES_START = "**Field: `order_numbers` (Array of Strings)**"
+_ORDER_RULES_END = "### OUTPUT FORMAT:"
+STANDARD_PROMPT_RAW_ORDERS = (
+    STANDARD_PROMPT[:STANDARD_PROMPT.index(_ORDER_RULES_START)]
+    + """**Field: `order_numbers` (String)**
+- Copy the specific codes/serials ONLY IF they are physically written directly inside the item's description cell INSIDE THE TABLE.
+- CRITICAL: DO NOT extract codes/serials from the general document "Nội dung" (Content/Reason) section at the top of the page (e.g., "Nhập lại VT tháo ra từ máy MOF 80-40/5A 21C783"). If the table row itself does not contain a code, you MUST return an empty string "".
+- Copy the codes EXACTLY as written, as ONE string. DO NOT expand ranges or add prefixes yourself; the server does that.
+  - Example: "25B827, 828, 621" -> "25B827, 828, 621"
+  - Example: "25B834-838" -> "25B834-838", "25B834-->838" -> "25B834-->838"
+
+"""
+    + STANDARD_PROMPT[STANDARD_PROMPT.index(_ORDER_RULES_END):].replace(
+        '"order_numbers": ["Code1", "Code2"]', '"order_numbers": "25B834-838, 840"'
+    )
+)
+
+# Appended to STANDARD_PROMPT when several pages are packed into one request
+STANDARD_PACKED_NOTE = """
+### MULTIPLE PAGES IN ONE REQUEST
+You will receive {count} page images. Each image is preceded by its label ("Image 1", "Image 2", ...) in page order.
+- Each image is a SEPARATE page. Apply ALL rules above to each page independently. Never merge rows across images.
+- Add the field "page" (integer: the image label number) to EVERY row.
+- Return ONE raw JSON Array containing the rows of all images, in image order.
+"""
+
 # 2. MATERIAL LIST PROMPT (Bảng kê vật tư - Dùng Pro)
 MATERIAL_LIST_PROMPT = """
 You are a data conversion engine. Convert this Bill of Materials PDF into a clean CSV.
@@ -151,92 +322,1186 @@ You are a data conversion engine. Convert this Bill of Materials PDF into a clea
         BẢNG KÊ MÁY BIẾN ÁP|26D 486-489|1|Dây Teflon|2.5mm2|m|10|14||
 """
 
-def pdf_to_images(file_bytes):
-    """Chuyển PDF thành hình ảnh (Chỉ dùng cho Standard Mode)"""
-    images = []
+# Appended to MATERIAL_LIST_PROMPT for every chunk after the first (chunked material_list mode)
+MATERIAL_LIST_CHUNK_NOTE = """
+        8.  **Continuation Chunk (CRITICAL):** These pages are a continuation of a longer document that was split into parts.
+            - The first pages may continue a list that started on an earlier page you cannot see.
+            - For rows BEFORE the first visible "Tên bảng" / "Mã code" on these pages, leave BOTH columns EMPTY. DO NOT guess or invent a list name or order number.
+            - Once a new list name / order number appears, repeat it on the following rows as usual.
+"""
+
+# --- METRICS / TRACING ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Counter tối giản theo định dạng Prometheus text (không cần prometheus_client)"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    """Histogram tối giản theo định dạng Prometheus text"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [bucket_counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    labels = _format_labels(self.labelnames, key, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+STAGE_SECONDS = Histogram(
+    "extractor_stage_seconds", "Time spent per pipeline stage.", ("stage", "mode", "model")
+)
+REQUESTS_TOTAL = Counter("extractor_requests_total", "Extraction requests by outcome.", ("mode", "outcome"))
+INPUT_BYTES = Counter("extractor_input_bytes_total", "Uploaded file bytes.", ("mode",))
+PAYLOAD_BYTES = Counter(
+    "extractor_payload_bytes_total", "Encoded (base64) bytes sent to Gemini.", ("mode", "model")
+)
+RESPONSE_CHARS = Counter(
+    "extractor_response_chars_total", "Characters of model output received.", ("mode", "model")
+)
+PAGE_PAYLOAD_BYTES = Histogram(
+    "extractor_page_payload_bytes", "Encoded image bytes per page by encoding profile.", ("profile", "format"),
+    buckets=(16384, 32768, 65536, 131072, 262144, 524288, 1048576, 2097152, 4194304, 8388608),
+)
+ROUTER_FALLBACKS = Counter(
+    "extractor_router_fallbacks_total", "Calls routed to the fallback model.", ("model", "fallback", "reason")
+)
+EXPORT_ROWS = Counter("extractor_export_rows_total", "Rows written to CSV/XLSX exports.", ("format", "source"))
+METRICS = [STAGE_SECONDS, REQUESTS_TOTAL, INPUT_BYTES, PAYLOAD_BYTES, RESPONSE_CHARS, PAGE_PAYLOAD_BYTES,
+           ROUTER_FALLBACKS, EXPORT_ROWS]
+
+# Mode của request hiện tại (tự lan sang các task con) để gắn label cho metrics
+CURRENT_MODE = contextvars.ContextVar("current_mode", default="")
+# Encoding profile của request hiện tại (mặc định ENCODING_PROFILE)
+CURRENT_PROFILE = contextvars.ContextVar("current_profile", default=ENCODING_PROFILE)
+# Deadline tuyệt đối (time.monotonic) của request hiện tại, None = không giới hạn
+CURRENT_DEADLINE = contextvars.ContextVar("current_deadline", default=None)
+# List các model đã phục vụ request hiện tại (dùng chung giữa các task con), None = không ghi nhận
+SERVED_MODELS = contextvars.ContextVar("served_models", default=None)
+# /extract/stream: callback nhận event preview ("rows") khi GEMINI_STREAMING bật, None = không preview
+ROW_PREVIEW = contextvars.ContextVar("row_preview", default=None)
+
+def record_encoding(info):
+    PAGE_PAYLOAD_BYTES.observe(info["bytes"], profile=info["profile"], format=info["format"])
+
+def _print_span(name, duration, attrs):
+    print(f"    [span] {name} {duration * 1000:.1f}ms {attrs}")
+
+_trace_hook = _print_span if TRACE_SPANS else None
+
+def set_trace_hook(hook):
+    """hook(name, duration_seconds, attrs) được gọi khi mỗi span kết thúc; None để tắt"""
+    global _trace_hook
+    _trace_hook = hook
+
+@contextmanager
+def span(stage, model="", **attrs):
+    """Đo thời gian một stage: ghi vào STAGE_SECONDS và gửi tới trace hook (nếu có)"""
+    mode = CURRENT_MODE.get()
+    started = time.perf_counter()
+    error = None
     try:
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        if doc.page_count > 0:
-            for page in doc:
-                # Giảm DPI từ 300 xuống 200 để tránh tràn bộ nhớ (OOM) với các file lớn
-                pix = page.get_pixmap(dpi=200) 
-                images.append(pix.tobytes("jpeg"))
-            return images
-        else:
-            raise Exception("PDF has no pages.")
-    except Exception as e:
-        print(f"PDF Conversion Error: {e}")
+        yield
+    except BaseException as e:
+        error = type(e).__name__
         raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, stage=stage, mode=mode, model=model)
+        if _trace_hook is not None:
+            _trace_hook(stage, duration, {"mode": mode, "model": model, "error": error, **attrs})
 
-def parse_material_csv(raw_text):
-    """Hàm thay thế Pandas để parse kết quả từ Gemini Pro CSV sang dạng Array Object JSON"""
-    clean_text = raw_text.replace("```csv", "").replace("```", "").strip()
-    clean_lines = []
-    for line in clean_text.split('\n'):
-        line = line.strip()
-        if line.count('|') >= 7 and "---" not in line:
-            clean_lines.append(line)
-            
-    if not clean_lines:
-        return []
+# --- GEMINI CLIENT ---
 
-    headers = [h.strip() for h in clean_lines[0].split('|')]
-    
-    def evaluate_math(val_str):
-        val_str = str(val_str).strip().replace('v', '').replace('V', '').replace('✓', '').replace('/', '')
-        
-        # Handle Addition
-        if '+' in val_str:
+class GeminiAPIError(Exception):
+    """Lỗi trả về từ Gemini API (status code khác 200 hoặc cấu trúc không hợp lệ)"""
+    def __init__(self, status_code, detail, retry_after=None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class MalformedOutputError(GeminiAPIError):
+    """Output đang stream không đúng định dạng mong đợi: hủy response sớm, không retry"""
+    def __init__(self, detail):
+        super().__init__(422, detail)
+
+_http_client = None
+
+def get_http_client():
+    """Trả về AsyncClient dùng chung (tạo lazily trong event loop hiện tại)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=GEMINI_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(GEMINI_TIMEOUT_FLASH, connect=GEMINI_CONNECT_TIMEOUT),
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# --- GEMINI SCHEDULER ---
+
+class TokenBucket:
+    """Token bucket đơn giản: `rate_per_minute` token/phút, tối đa `burst` token"""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+class GeminiScheduler:
+    """Điều phối mọi lời gọi Gemini trong process: giới hạn in-flight toàn cục,
+    rate limit theo model và round-robin giữa các tài liệu (doc_id)"""
+
+    def __init__(self, max_in_flight, buckets):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.buckets = buckets
+        self.in_flight = 0
+        self._queues = {}      # doc_id -> deque[(model, future, enqueued_at)]
+        self._order = deque()  # vòng round-robin các doc_id đang chờ
+        self._timer = None
+        self.stats = {}
+
+    def _model_stats(self, model):
+        if model not in self.stats:
+            self.stats[model] = {"dispatched": 0, "wait_total": 0.0, "wait_max": 0.0}
+        return self.stats[model]
+
+    @asynccontextmanager
+    async def slot(self, doc_id, model):
+        entry = (model, asyncio.get_running_loop().create_future(), time.monotonic())
+        if doc_id not in self._queues:
+            self._queues[doc_id] = deque()
+            self._order.append(doc_id)
+        self._queues[doc_id].append(entry)
+        self._dispatch()
+
+        fut = entry[1]
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()
+            else:
+                self._discard(doc_id, entry)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _discard(self, doc_id, entry):
+        queue = self._queues.get(doc_id)
+        if queue is not None and entry in queue:
+            queue.remove(entry)
+            if not queue:
+                del self._queues[doc_id]
+                self._order.remove(doc_id)
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def close(self):
+        """Hủy timer rate limit đang chờ (gắn với event loop sắp đóng)"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _dispatch(self):
+        retry_after = None
+        while self.in_flight < self.max_in_flight and self._order:
+            granted = False
+            for _ in range(len(self._order)):
+                doc_id = self._order[0]
+                self._order.rotate(-1)
+                queue = self._queues[doc_id]
+                model, fut, enqueued_at = queue[0]
+
+                bucket = self.buckets.get(model)
+                if bucket is not None and not bucket.try_take():
+                    wait = bucket.wait_time()
+                    retry_after = wait if retry_after is None else min(retry_after, wait)
+                    continue
+
+                queue.popleft()
+                if not queue:
+                    del self._queues[doc_id]
+                    self._order.remove(doc_id)
+
+                waited = time.monotonic() - enqueued_at
+                model_stats = self._model_stats(model)
+                model_stats["dispatched"] += 1
+                model_stats["wait_total"] += waited
+                model_stats["wait_max"] = max(model_stats["wait_max"], waited)
+
+                self.in_flight += 1
+                fut.set_result(None)
+                granted = True
+                break
+            if not granted:
+                break
+
+        if retry_after is not None and self._timer is None and self._order:
+            self._timer = asyncio.get_running_loop().call_later(max(retry_after, 0.01), self._on_timer)
+
+    def snapshot(self):
+        queued_by_model = {}
+        for queue in self._queues.values():
+            for model, _, _ in queue:
+                queued_by_model[model] = queued_by_model.get(model, 0) + 1
+        models = {}
+        for model, model_stats in self.stats.items():
+            dispatched = model_stats["dispatched"]
+            models[model] = {
+                "dispatched": dispatched,
+                "queued": queued_by_model.get(model, 0),
+                "avg_wait_seconds": round(model_stats["wait_total"] / dispatched, 4) if dispatched else 0.0,
+                "max_wait_seconds": round(model_stats["wait_max"], 4),
+            }
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": sum(queued_by_model.values()),
+            "active_documents": len(self._queues),
+            "models": models,
+        }
+
+GEMINI_SCHEDULER = GeminiScheduler(GEMINI_MAX_IN_FLIGHT, {
+    GEMINI_MODEL_FLASH: TokenBucket(GEMINI_RPM_FLASH, GEMINI_BURST_FLASH),
+    GEMINI_MODEL_PRO: TokenBucket(GEMINI_RPM_PRO, GEMINI_BURST_PRO),
+})
+
+# --- RETRY / HEDGING ---
+
+class LatencyTracker:
+    """Cửa sổ trượt độ trễ (giây) của các lời gọi thành công, theo model"""
+
+    def __init__(self, window):
+        self.window = window
+        self._samples = {}
+
+    def record(self, model, seconds):
+        if model not in self._samples:
+            self._samples[model] = deque(maxlen=self.window)
+        self._samples[model].append(seconds)
+
+    def percentile(self, model, q, min_samples=1):
+        samples = self._samples.get(model)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+GEMINI_LATENCY = LatencyTracker(GEMINI_LATENCY_WINDOW)
+GEMINI_CALL_STATS = {}
+
+def gemini_call_stats(model):
+    if model not in GEMINI_CALL_STATS:
+        GEMINI_CALL_STATS[model] = {
+            "calls": 0, "attempts": 0, "retries": 0, "hedged": 0, "hedge_wins": 0, "failures": 0
+        }
+    return GEMINI_CALL_STATS[model]
+
+def parse_retry_after(value):
+    """Retry-After có thể là số giây hoặc HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(error):
+    if isinstance(error, GeminiAPIError):
+        return error.status_code in GEMINI_RETRY_STATUSES
+    return isinstance(error, httpx.TransportError)
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff; Retry-After của server được ưu tiên nếu dài hơn"""
+    delay = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, GEMINI_RETRY_AFTER_MAX))
+    return delay
+
+async def _scheduled_attempt(url, payload, model_name, doc_id, timeout, stream_parser=None, on_items=None):
+    """Một lần gọi (qua scheduler) với deadline tổng cho cả lần gọi"""
+    queued_at = time.perf_counter()
+    async with GEMINI_SCHEDULER.slot(doc_id, model_name):
+        STAGE_SECONDS.observe(
+            time.perf_counter() - queued_at, stage="queue_wait", mode=CURRENT_MODE.get(), model=model_name
+        )
+        gemini_call_stats(model_name)["attempts"] += 1
+        started = time.monotonic()
+        try:
+            with span("model_call", model=model_name, doc_id=doc_id):
+                if GEMINI_STREAMING and stream_parser is not None:
+                    call = _post_generate_stream(url, payload, timeout, stream_parser(), on_items)
+                else:
+                    call = _post_generate(url, payload, timeout)
+                text = await asyncio.wait_for(call, timeout=timeout)
+        except asyncio.TimeoutError:
+            MODEL_ROUTER.record(model_name, False)
+            raise GeminiAPIError(504, f"Gemini call exceeded deadline of {timeout}s.")
+        except (GeminiAPIError, httpx.TransportError) as e:
+            if is_retryable(e):
+                MODEL_ROUTER.record(model_name, False)
+            raise
+        MODEL_ROUTER.record(model_name, True)
+        GEMINI_LATENCY.record(model_name, time.monotonic() - started)
+        return text
+
+async def _hedged_attempt(url, payload, model_name, doc_id, timeout, stream_parser=None, on_items=None):
+    """Nếu lần gọi chậm hơn percentile cấu hình, bắn thêm một bản sao và lấy kết quả về trước.
+    Chỉ lần gọi chính gửi preview (on_items) để các dòng không bị lặp"""
+    primary = asyncio.create_task(
+        _scheduled_attempt(url, payload, model_name, doc_id, timeout, stream_parser, on_items)
+    )
+    threshold = None
+    if GEMINI_HEDGE_ENABLED:
+        threshold = GEMINI_LATENCY.percentile(model_name, GEMINI_HEDGE_PERCENTILE, GEMINI_HEDGE_MIN_SAMPLES)
+
+    pending = {primary}
+    try:
+        if threshold is None:
+            return await primary
+        done, _ = await asyncio.wait(pending, timeout=threshold)
+        if done:
+            return primary.result()
+
+        gemini_call_stats(model_name)["hedged"] += 1
+        hedge = asyncio.create_task(_scheduled_attempt(url, payload, model_name, doc_id, timeout, stream_parser))
+        pending.add(hedge)
+        first_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        gemini_call_stats(model_name)["hedge_wins"] += 1
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def gemini_generate(url, payload, model_name, doc_id=None, timeout=None, stream_parser=None, on_items=None):
+    """Gọi generateContent (qua scheduler, có retry/hedging) và trả về text của candidate đầu tiên.
+    stream_parser: factory parser incremental -> dùng streamGenerateContent khi GEMINI_STREAMING bật;
+    on_items(items) nhận các phần tử parse xong trong lúc model còn đang sinh"""
+    doc_id = doc_id or uuid.uuid4().hex
+    stats = gemini_call_stats(model_name)
+    stats["calls"] += 1
+    attempt = 0
+    while True:
+        try:
+            return await _hedged_attempt(url, payload, model_name, doc_id, timeout, stream_parser, on_items)
+        except (GeminiAPIError, httpx.TransportError) as e:
+            if not is_retryable(e) or attempt >= GEMINI_MAX_RETRIES:
+                stats["failures"] += 1
+                raise
+            delay = backoff_delay(attempt, getattr(e, "retry_after", None))
+            remaining = deadline_remaining()
+            if remaining is not None and delay >= remaining:
+                stats["failures"] += 1
+                raise
+            print(f"    {model_name} attempt {attempt+1} failed ({type(e).__name__}: "
+                  f"{str(e)[:120]}), retrying in {delay:.1f}s")
+            stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+async def _post_generate(url, payload, timeout=None):
+    request_timeout = httpx.USE_CLIENT_DEFAULT
+    if timeout is not None:
+        request_timeout = httpx.Timeout(timeout, connect=GEMINI_CONNECT_TIMEOUT)
+
+    content, headers = encode_payload(payload)
+    response = await get_http_client().post(url, content=content, headers=headers, timeout=request_timeout)
+    if response.status_code != 200:
+        raise GeminiAPIError(
+            response.status_code, response.text, parse_retry_after(response.headers.get("retry-after"))
+        )
+
+    try:
+        return response.json()["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, ValueError):
+        raise GeminiAPIError(500, "Gemini returned unexpected structure.")
+
+def stream_url(url):
+    """URL generateContent -> streamGenerateContent dạng Server-Sent Events"""
+    return url.replace(":generateContent?", ":streamGenerateContent?alt=sse&", 1)
+
+async def _post_generate_stream(url, payload, timeout, parser, on_items=None):
+    """streamGenerateContent: ghép text theo từng event SSE, đưa vào parser incremental.
+    Parser báo output hỏng -> đóng kết nối ngay (model ngừng sinh), không chờ hết response"""
+    request_timeout = httpx.USE_CLIENT_DEFAULT
+    if timeout is not None:
+        request_timeout = httpx.Timeout(timeout, connect=GEMINI_CONNECT_TIMEOUT)
+
+    content, headers = encode_payload(payload)
+    texts = []
+    async with get_http_client().stream(
+        "POST", stream_url(url), content=content, headers=headers, timeout=request_timeout
+    ) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise GeminiAPIError(
+                response.status_code, response.text, parse_retry_after(response.headers.get("retry-after"))
+            )
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
             try:
-                total = sum(float(i.strip().replace(',', '.')) for i in val_str.split('+') if i.strip())
-                return int(total) if total.is_integer() else total
-            except Exception:
-                pass
-                
-        # Handle Subtraction (e.g. 5-2)
-        if '-' in val_str and not val_str.startswith('-'):
+                event = json.loads(line[5:])
+            except ValueError:
+                raise GeminiAPIError(500, "Gemini returned unexpected structure.")
+            if "error" in event:
+                error = event["error"]
+                raise GeminiAPIError(error.get("code", 500), error.get("message", str(error)))
             try:
-                parts = [float(i.strip().replace(',', '.')) for i in val_str.split('-') if i.strip()]
-                if len(parts) > 1:
-                    total = parts[0]
-                    for p in parts[1:]:
-                        total -= p
-                    return int(total) if total.is_integer() else total
-            except Exception:
-                pass
-                
-        # Handle Multiplication (x or *)
-        val_str_mult = val_str.lower().replace('*', 'x')
-        if 'x' in val_str_mult:
+                parts = event["candidates"][0]["content"]["parts"]
+            except (KeyError, IndexError, TypeError):
+                continue  # event chỉ có finishReason / usageMetadata
+            text = "".join(part.get("text", "") for part in parts)
+            if not text:
+                continue
+            texts.append(text)
+            items = parser.feed(text)
+            if items and on_items is not None:
+                on_items(items)
+
+    if not texts:
+        raise GeminiAPIError(500, "Gemini returned unexpected structure.")
+    items = parser.close()
+    if items and on_items is not None:
+        on_items(items)
+    return "".join(texts)
+
+# --- MODEL ROUTER ---
+
+class CircuitBreaker:
+    """Tỉ lệ lỗi trượt theo N lần gọi gần nhất; vượt ngưỡng -> open trong cooldown giây,
+    sau đó half-open: chỉ MỘT lời gọi thử tại một thời điểm, thành công thì đóng lại, lỗi thì mở tiếp"""
+
+    def __init__(self, window, error_rate, min_calls, cooldown):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.open_until = 0.0
+        self.half_open = False
+        self.probing = False  # half-open: đang có lời gọi thử
+        self.trips = 0
+
+    def state(self):
+        if time.monotonic() < self.open_until:
+            return "open"
+        return "half_open" if self.half_open else "closed"
+
+    def available(self):
+        """closed, hoặc half-open và chưa có lời gọi thử nào đang chạy"""
+        state = self.state()
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def acquire(self):
+        """Trước mỗi lời gọi: False khi open hoặc đã có lời gọi thử; half-open -> lời gọi này là lời gọi thử"""
+        if not self.available():
+            return False
+        if self.state() == "half_open":
+            self.probing = True
+        return True
+
+    def release(self):
+        self.probing = False
+
+    def failure_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def record(self, ok):
+        if self.half_open and time.monotonic() >= self.open_until:
+            self.half_open = False
+            if not ok:
+                self._trip()
+                return
+        self.outcomes.append(ok)
+        if (not ok and len(self.outcomes) >= self.min_calls and self.failure_rate() >= self.error_rate
+                and self.state() == "closed"):
+            self._trip()
+
+    def _trip(self):
+        self.open_until = time.monotonic() + self.cooldown
+        self.half_open = True
+        self.trips += 1
+        self.outcomes.clear()
+
+class ModelRouter:
+    """Chọn model cho từng lời gọi theo deadline còn lại, latency gần đây (GEMINI_LATENCY) và circuit breaker"""
+
+    def __init__(self, urls, fallbacks):
+        self.urls = urls            # model -> generateContent URL
+        self.fallbacks = fallbacks  # model -> model dự phòng
+        self.breakers = {
+            model: CircuitBreaker(ROUTER_ERROR_WINDOW, ROUTER_BREAKER_ERROR_RATE,
+                                  ROUTER_BREAKER_MIN_CALLS, ROUTER_BREAKER_COOLDOWN)
+            for model in urls
+        }
+
+    def record(self, model, ok):
+        breaker = self.breakers.get(model)
+        if breaker is not None:
+            breaker.record(ok)
+
+    def estimate(self, model):
+        """Độ trễ dự kiến (giây) của một lời gọi, None khi chưa đủ mẫu"""
+        return GEMINI_LATENCY.percentile(model, ROUTER_LATENCY_PERCENTILE, ROUTER_MIN_SAMPLES)
+
+    def plan(self, preferred, remaining=None):
+        """Thứ tự model sẽ thử cho một lời gọi (model đầu tiên là model chính)"""
+        fallback = self.fallbacks.get(preferred) if ROUTER_FALLBACK_ENABLED else None
+        if fallback is None:
+            return [preferred]
+        # Half-open với lời gọi thử đang chạy cũng coi như open: traffic khác đi sang model dự phòng
+        preferred_open = not self.breakers[preferred].available()
+        fallback_open = not self.breakers[fallback].available()
+        if preferred_open and not fallback_open:
+            return [fallback, preferred]
+        if remaining is not None and not fallback_open:
+            preferred_estimate, fallback_estimate = self.estimate(preferred), self.estimate(fallback)
+            if (preferred_estimate is not None and preferred_estimate > remaining
+                    and (fallback_estimate is None or fallback_estimate < preferred_estimate)):
+                return [fallback, preferred]
+        return [preferred] if fallback_open else [preferred, fallback]
+
+    def snapshot(self):
+        models = {}
+        for model, breaker in self.breakers.items():
+            models[model] = {
+                "state": breaker.state(),
+                "probing": breaker.probing,
+                "error_rate": round(breaker.failure_rate(), 3),
+                "recent_calls": len(breaker.outcomes),
+                "trips": breaker.trips,
+                "latency_estimate_seconds": self.estimate(model),
+                "fallback": self.fallbacks.get(model),
+            }
+        return {"fallback_enabled": ROUTER_FALLBACK_ENABLED, "slo_tiers": SLO_TIERS, "models": models}
+
+MODEL_ROUTER = ModelRouter(
+    {GEMINI_MODEL_FLASH: GEMINI_URL_FLASH, GEMINI_MODEL_PRO: GEMINI_URL_PRO},
+    {GEMINI_MODEL_FLASH: GEMINI_MODEL_PRO, GEMINI_MODEL_PRO: GEMINI_MODEL_FLASH},
+)
+
+def deadline_remaining():
+    deadline = CURRENT_DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+async def routed_generate(url, payload, model_name, doc_id=None, timeout=None, stream_parser=None, on_items=None):
+    """gemini_generate qua router: (url, model_name) là model ưu tiên của mode; prompt và response format
+    nằm trong payload nên giữ nguyên khi chuyển model. Trả về (text, model đã phục vụ)"""
+    plan = MODEL_ROUTER.plan(model_name, deadline_remaining())
+    for attempt, model in enumerate(plan):
+        remaining = deadline_remaining()
+        if remaining is not None and remaining <= 0:
+            raise GeminiAPIError(504, "Request deadline exceeded before the model call.")
+        call_timeout = timeout if remaining is None else min(timeout or remaining, remaining)
+        breaker = MODEL_ROUTER.breakers[model]
+        probe = breaker.state() == "half_open"
+        if not breaker.acquire():
+            if attempt < len(plan) - 1:
+                # Breaker đổi trạng thái sau khi lập plan (vd. lời gọi thử khác vừa bắt đầu)
+                ROUTER_FALLBACKS.inc(model=model, fallback=plan[attempt + 1], reason="circuit_open")
+                continue
+            probe = False  # không còn model nào khác: vẫn gọi
+        try:
+            text = await gemini_generate(
+                url if model == model_name else MODEL_ROUTER.urls[model], payload, model,
+                doc_id=doc_id, timeout=call_timeout, stream_parser=stream_parser, on_items=on_items,
+            )
+        except (GeminiAPIError, httpx.TransportError) as e:
+            if attempt == len(plan) - 1 or not is_retryable(e):
+                raise
+            ROUTER_FALLBACKS.inc(model=model, fallback=plan[attempt + 1], reason="error")
+            print(f"    {model} failed ({type(e).__name__}: {str(e)[:120]}), falling back to {plan[attempt + 1]}.")
+            continue
+        finally:
+            if probe:
+                breaker.release()
+        if model != model_name and attempt == 0:
+            reason = "circuit_open" if MODEL_ROUTER.breakers[model_name].state() != "closed" else "deadline"
+            ROUTER_FALLBACKS.inc(model=model_name, fallback=model, reason=reason)
+        served = SERVED_MODELS.get()
+        if served is not None and model not in served:
+            served.append(model)
+        return text, model
+
+# --- STREAMING REQUEST BODY ---
+
+# Bội số của 3: base64 của từng chunk nối lại đúng bằng base64 của cả file
+PAYLOAD_CHUNK_BYTES = 3 * 256 * 1024
+
+class FileData:
+    """inline_data trỏ tới file trên đĩa: base64 được sinh dần khi gửi request, không nằm trọn trong RAM"""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def b64_size(self):
+        return 4 * ((self.size + 2) // 3)
+
+def make_file_part(path, mime_type):
+    return {"inline_data": {"mime_type": mime_type, "data": FileData(path)}}
+
+def inline_part_size(part):
+    """Số bytes base64 của một inline part (chuỗi sẵn có hoặc FileData)"""
+    data = part["inline_data"]["data"]
+    return data.b64_size() if isinstance(data, FileData) else len(data)
+
+async def iter_file_base64(path):
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, PAYLOAD_CHUNK_BYTES):
+            yield base64.b64encode(chunk)
+
+def encode_payload(payload):
+    """JSON body cho generateContent -> (content, headers). Không có FileData: bytes như cũ;
+    có FileData: async iterator stream base64 từng chunk, Content-Length tính trước"""
+    files = []
+    marker = uuid.uuid4().hex
+
+    def placeholder(obj):
+        if isinstance(obj, FileData):
+            files.append(obj)
+            return f"{marker}{len(files) - 1}"
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=placeholder)
+    headers = {"Content-Type": "application/json"}
+    if not files:
+        return text.encode("utf-8"), headers
+
+    # pieces: [json, file index, json, file index, ..., json]
+    pieces = re.split(f'"{marker}(\\d+)"', text)
+    segments = [piece.encode("utf-8") if n % 2 == 0 else files[int(piece)] for n, piece in enumerate(pieces)]
+    headers["Content-Length"] = str(sum(
+        len(segment) if isinstance(segment, bytes) else segment.b64_size() + 2 for segment in segments
+    ))
+
+    async def body():
+        for segment in segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield b'"'
+                async for chunk in iter_file_base64(segment.path):
+                    yield chunk
+                yield b'"'
+
+    return body(), headers
+
+# --- UPLOADS / ADMISSION CONTROL ---
+
+class SpooledUpload:
+    """File upload nằm trên đĩa (path, size, sha256) thay vì bytes trong RAM"""
+
+    def __init__(self, path, size, digest, owned=True):
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.owned = owned  # owned=True: close() xóa file
+
+    @classmethod
+    def from_path(cls, path, owned=False):
+        """Đọc file theo chunk để tính sha256 (chạy trong thread)"""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(UPLOAD_CHUNK_BYTES):
+                digest.update(chunk)
+        return cls(path, os.path.getsize(path), digest.hexdigest(), owned)
+
+    def close(self):
+        if self.owned and self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.path = None
+
+async def spool_upload(file, directory=None):
+    """Chép UploadFile xuống file tạm theo chunk (giữ phần mở rộng), tính sha256 trên đường đi.
+    Hash + ghi đĩa của từng chunk chạy trong thread, không chặn event loop"""
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(file.filename or "")[1].lower(), dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            def write_chunk(chunk):
+                digest.update(chunk)
+                out.write(chunk)
+
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                await asyncio.to_thread(write_chunk, chunk)
+                size += len(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return SpooledUpload(path, size, digest.hexdigest())
+
+class ByteBudget:
+    """Admission control theo tổng bytes upload đang xử lý (FIFO). Một file lớn hơn cả budget
+    vẫn được chạy khi không còn gì khác đang giữ budget"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._waiters = deque()  # (size, future)
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0}
+
+    def _fits(self, size):
+        return self.in_flight == 0 or self.in_flight + size <= self.max_bytes
+
+    async def acquire(self, size, timeout=None):
+        """Giữ `size` bytes; chờ tối đa `timeout` giây (None = chờ mãi) rồi 503"""
+        if not self._waiters and self._fits(size):
+            self.in_flight += size
+            self.stats["admitted"] += 1
+            return
+        if timeout is not None and timeout <= 0:
+            self._reject(size)
+        entry = (size, asyncio.get_running_loop().create_future())
+        self._waiters.append(entry)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[1]), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry[1].done() and not entry[1].cancelled():
+                self.release(size)
+            else:
+                self._waiters.remove(entry)
+                self._dispatch()
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject(size)
+            raise
+        self.stats["admitted"] += 1
+
+    def _reject(self, size):
+        self.stats["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail=f"Server busy: {self.in_flight} upload bytes in flight (budget {self.max_bytes}), "
+                   f"cannot admit {size} more. Retry later.",
+            headers={"Retry-After": str(max(int(INFLIGHT_QUEUE_SECONDS), 1))},
+        )
+
+    def release(self, size):
+        self.in_flight -= size
+        self._dispatch()
+
+    def _dispatch(self):
+        # FIFO: file lớn ở đầu hàng không bị các file nhỏ phía sau vượt mặt
+        while self._waiters and self._fits(self._waiters[0][0]):
+            size, fut = self._waiters.popleft()
+            if fut.cancelled():
+                continue
+            self.in_flight += size
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def reserve(self, size, timeout=None):
+        await self.acquire(size, timeout)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def snapshot(self):
+        return {"max_bytes": self.max_bytes, "in_flight_bytes": self.in_flight,
+                "waiting": len(self._waiters), **self.stats}
+
+UPLOAD_BUDGET = ByteBudget(INFLIGHT_MAX_BYTES)
+
+# --- RESULT CACHE ---
+
+def sha256_hex(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+class ResultCache:
+    """Cache 2 tầng (LRU trong RAM + SQLite trên đĩa) cho kết quả trích xuất đã xử lý"""
+
+    def __init__(self, max_bytes, db_path=None, max_disk_entries=5000, table="results"):
+        self.table = table
+        self.max_bytes = max_bytes
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()  # key -> (json_text, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0,
+                      "disk_errors": 0}
+        # Trim đĩa theo lô: chỉ khi vượt max_disk_entries thêm 1% (tối thiểu 1 bản ghi)
+        self._trim_batch = max(max_disk_entries // 100, 1)
+        self._disk_entries = 0
+        self._db = None
+        if db_path:
             try:
-                parts = [float(i.strip().replace(',', '.')) for i in val_str_mult.split('x') if i.strip()]
-                if parts:
-                    total = 1.0
-                    for p in parts:
-                        total *= p
-                    return int(total) if total.is_integer() else total
-            except Exception:
-                pass
-                
-        return val_str
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)")
+                self._db.commit()
+                self._disk_entries = self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            except sqlite3.Error as e:
+                print(f"WARNING: Result cache disk tier disabled: {e}")
+                self._db = None
+
+    def _remember(self, key, text):
+        size = len(text)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (text, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self._bytes -= old_size
+            self.stats["evictions"] += 1
+
+    def _disk_error(self, operation, error):
+        """Tầng đĩa chỉ là best-effort: DB bị khóa / hỏng / đầy thì coi như miss hoặc bỏ qua lần ghi"""
+        self.stats["disk_errors"] += 1
+        print(f"WARNING: Result cache ({self.table}) disk {operation} failed: {error}")
+        try:
+            self._db.rollback()
+        except sqlite3.Error:
+            pass
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return json.loads(self._entries[key][0])
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                    if row:
+                        self._db.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                        self._db.commit()
+                except sqlite3.Error as e:
+                    self._disk_error("read", e)
+                    row = None
+                if row:
+                    self._remember(key, row[0])
+                    self.stats["disk_hits"] += 1
+                    return json.loads(row[0])
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        text = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, text)
+            self.stats["stores"] += 1
+            if self._db is not None:
+                try:
+                    self._put_disk(key, text)
+                except sqlite3.Error as e:
+                    self._disk_error("write", e)
+
+    def _put_disk(self, key, text):
+        now = time.time()
+        exists = self._db.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        self._db.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, text, now, now),
+        )
+        if not exists:
+            self._disk_entries += 1
+        # Xóa các bản ghi ít dùng nhất (qua index accessed_at) khi vượt quá giới hạn một lô
+        if self._disk_entries >= self.max_disk_entries + self._trim_batch:
+            # Đếm lại (process khác có thể dùng chung file DB) trước khi xóa
+            self._disk_entries = self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            self._disk_entries -= self._db.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+                (self._disk_entries - self.max_disk_entries,),
+            ).rowcount
+        self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                try:
+                    self._db.execute(f"DELETE FROM {self.table}")
+                    self._db.commit()
+                    self._disk_entries = 0
+                except sqlite3.Error as e:
+                    self._disk_error("clear", e)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            disk_entries = self._disk_entries if self._db is not None else None
+            return {
+                **self.stats,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._entries),
+                "memory_bytes": self._bytes,
+                "memory_max_bytes": self.max_bytes,
+                "disk_entries": disk_entries,
+            }
+
+RESULT_CACHE = ResultCache(CACHE_MEMORY_MAX_BYTES, CACHE_DB_PATH, CACHE_DISK_MAX_ENTRIES) if CACHE_ENABLED else None
+PAGE_CACHE = ResultCache(
+    PAGE_CACHE_MEMORY_MAX_BYTES, CACHE_DB_PATH, PAGE_CACHE_DISK_MAX_ENTRIES, table="page_results"
+) if CACHE_ENABLED else None
+
+def result_cache_key(file_sha256, mode, model_name, system_prompt, profile="jpeg"):
+    return ":".join([file_sha256, mode, model_name, sha256_hex(system_prompt), profile])
+
+def page_cache_key(img_part, model_name, system_prompt):
+    """Key theo nội dung ảnh trang đã render (không phụ thuộc vào file PDF chứa nó)"""
+    return ":".join([sha256_hex(img_part["inline_data"]["data"]), model_name, sha256_hex(system_prompt)])
+
+def is_blank_page(features):
+    return features["ink_ratio"] < TRIAGE_BLANK_INK_RATIO and features["stddev"] < TRIAGE_BLANK_STDDEV
+
+# --- CPU OFFLOAD (PROCESS POOL) ---
+
+_render_pool = None
+_render_slots = None
+_render_slots_loop = None
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None and RENDER_WORKERS > 0:
+        # Pool được tạo lazily khi server đã có nhiều thread: không dùng fork. Các hàm gửi vào pool nằm trong
+        # render.py nên worker chỉ import module đó (không tạo lại app, cache hay job store)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=context)
+    return _render_pool
+
+def shutdown_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+def get_render_slots():
+    """Semaphore giới hạn hàng đợi render, gắn với event loop đang chạy"""
+    global _render_slots, _render_slots_loop
+    loop = asyncio.get_running_loop()
+    if _render_slots is None or _render_slots_loop is not loop:
+        _render_slots = asyncio.Semaphore(max(RENDER_QUEUE_DEPTH, 1))
+        _render_slots_loop = loop
+    return _render_slots
+
+async def run_cpu_bound(fn, *args):
+    """Chạy hàm CPU-bound trong process pool (giới hạn hàng đợi) mà không chặn event loop"""
+    async with get_render_slots():
+        pool = get_render_pool()
+        if pool is None:
+            return await asyncio.to_thread(fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+def material_csv_line(line):
+    """Một dòng output -> dòng CSV hợp lệ (đã bỏ fence) hoặc None"""
+    line = line.replace("```csv", "").replace("```", "").strip()
+    if line.count('|') >= 7 and "---" not in line:
+        return line
+    return None
+
+def material_csv_lines(raw_text):
+    """Lấy các dòng CSV hợp lệ (header + data) từ output thô của Gemini"""
+    return [line for line in map(material_csv_line, raw_text.split('\n')) if line is not None]
+
+def stitch_material_csv(chunk_texts):
+    """Nối CSV của các chunk theo thứ tự trang: giữ header của chunk đầu, bỏ header các chunk sau.
+    Dòng đầu chunk sau không có Tên bảng / Mã code sẽ được parse_material_csv gán theo last_valid_key."""
+    header = None
+    rows = []
+    for text in chunk_texts:
+        lines = material_csv_lines(text)
+        if not lines:
+            continue
+        first_upper = lines[0].upper()
+        if "TÊN BẢNG" in first_upper or "STT" in first_upper:
+            header = header or lines[0]
+            lines = lines[1:]
+        rows.extend(lines)
+    if header is None:
+        return ""
+    return "\n".join([header] + rows)
+
+def evaluate_math(val_str):
+    """Tính biểu thức đơn giản trong ô số lượng ("3+2", "5-2", "2x3"); không tính được thì trả về chuỗi"""
+    val_str = str(val_str).strip().replace('v', '').replace('V', '').replace('✓', '').replace('/', '')
+    
+    # Handle Addition
+    if '+' in val_str:
+        try:
+            total = sum(float(i.strip().replace(',', '.')) for i in val_str.split('+') if i.strip())
+            return int(total) if total.is_integer() else total
+        except Exception:
+            pass
+            
+    # Handle Subtraction (e.g. 5-2)
+    if '-' in val_str and not val_str.startswith('-'):
+        try:
+            parts = [float(i.strip().replace(',', '.')) for i in val_str.split('-') if i.strip()]
+            if len(parts) > 1:
+                total = parts[0]
+                for p in parts[1:]:
+                    total -= p
+                return int(total) if total.is_integer() else total
+        except Exception:
+            pass
+            
+    # Handle Multiplication (x or *)
+    val_str_mult = val_str.lower().replace('*', 'x')
+    if 'x' in val_str_mult:
+        try:
+            parts = [float(i.strip().replace(',', '.')) for i in val_str_mult.split('x') if i.strip()]
+            if parts:
+                total = 1.0
+                for p in parts:
+                    total *= p
+                return int(total) if total.is_integer() else total
+        except Exception:
+            pass
+            
+    return val_str
 
-    grouped_data = {}
-    ordered_keys = []
-    last_valid_key = ("Bảng kê vật tư", "N/A")
+# Nhóm mặc định khi chưa có dòng nào ghi Tên bảng / Mã code; (None, None) = chưa biết (chunk ≥1 khi preview)
+MATERIAL_DEFAULT_KEY = ("Bảng kê vật tư", "N/A")
+MATERIAL_UNKNOWN_KEY = (None, None)
+
+class MaterialCsvParser:
+    """Parse CSV (Gemini Pro) từng dòng sang nhóm (Tên bảng, Mã code): dòng hợp lệ đầu tiên là header,
+    last_valid_key được mang sang các dòng sau. Dùng cho cả output đầy đủ lẫn output đang stream (feed)"""
+
+    def __init__(self, last_valid_key=MATERIAL_DEFAULT_KEY):
+        self.headers = None
+        self.grouped_data = {}
+        self.ordered_keys = []
+        self.last_valid_key = last_valid_key
+        self._pending = ""   # dòng chưa có ký tự xuống dòng (streaming)
+        self._preamble = 0   # số ký tự rác trước header
+
+    def add_line(self, line):
+        """line: dòng CSV hợp lệ. Trả về (key, row_dict) hoặc None nếu là header"""
+        if self.headers is None:
+            self.headers = [h.strip() for h in line.split('|')]
+            return None
 
-    for line in clean_lines[1:]:
         parts = [p.strip() for p in line.split('|')]
         # Pad parts just in case
-        while len(parts) < len(headers):
+        while len(parts) < len(self.headers):
             parts.append("")
-        
-        full_row_dict = dict(zip(headers, parts[:len(headers)]))
-        
+
+        full_row_dict = dict(zip(self.headers, parts[:len(self.headers)]))
+
         # Extract Grouping Keys and separate them from actual row data
         list_name = ""
         order_number = ""
         row_dict = {}
-        
+
         for k, v in full_row_dict.items():
             k_upper = k.upper()
             if "TÊN BẢNG" in k_upper or "LIST NAME" in k_upper:
@@ -245,36 +1510,347 @@ def parse_material_csv(raw_text):
                 order_number = v
             else:
                 row_dict[k] = v
-        
+
         # Cleanup math
         for col in ['Định mức', 'Thực lĩnh']:
             if col in row_dict:
                 row_dict[col] = evaluate_math(row_dict[col])
-                
+
         # Carry over logic if AI misses repeating them on next page
         if not list_name and not order_number:
-            list_name, order_number = last_valid_key
+            list_name, order_number = self.last_valid_key
         else:
-            if not list_name: list_name = last_valid_key[0]
-            if not order_number: order_number = last_valid_key[1]
-            last_valid_key = (list_name, order_number)
-            
+            if not list_name: list_name = self.last_valid_key[0]
+            if not order_number: order_number = self.last_valid_key[1]
+            self.last_valid_key = (list_name, order_number)
+
         key = (list_name, order_number)
-        if key not in grouped_data:
-            grouped_data[key] = []
-            ordered_keys.append(key)
-        
-        grouped_data[key].append(row_dict)
-        
-    result = []
-    for key in ordered_keys:
-        result.append({
-            "list_name": key[0],
-            "order_number": key[1],
-            "data": grouped_data[key]
-        })
-        
-    return result
+        if key not in self.grouped_data:
+            self.grouped_data[key] = []
+            self.ordered_keys.append(key)
+
+        self.grouped_data[key].append(row_dict)
+        return key, row_dict
+
+    def _add_raw_line(self, raw_line, rows):
+        line = material_csv_line(raw_line)
+        if line is None:
+            if self.headers is None:
+                self._preamble += len(raw_line.strip())
+                if self._preamble > GEMINI_STREAM_MAX_PREAMBLE:
+                    raise MalformedOutputError(f"No CSV header after {self._preamble} chars of output.")
+            return
+        row = self.add_line(line)
+        if row is not None:
+            rows.append(row)
+
+    def feed(self, text):
+        """Streaming: nhận thêm text, trả về list (key, row_dict) của các dòng vừa hoàn chỉnh"""
+        rows = []
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        for raw_line in lines:
+            self._add_raw_line(raw_line, rows)
+        return rows
+
+    def close(self):
+        rows = []
+        if self._pending:
+            self._add_raw_line(self._pending, rows)
+            self._pending = ""
+        return rows
+
+    def result(self):
+        return [
+            {"list_name": key[0], "order_number": key[1], "data": self.grouped_data[key]}
+            for key in self.ordered_keys
+        ]
+
+class MaterialAttemptParser(MaterialCsvParser):
+    """MaterialCsvParser cho một lần gọi model của một chunk: feed/close trả về (attempt, key, row_dict)"""
+
+    def __init__(self, last_valid_key, attempt):
+        super().__init__(last_valid_key)
+        self.attempt = attempt
+
+    def feed(self, text):
+        return [(self.attempt, key, row) for key, row in super().feed(text)]
+
+    def close(self):
+        return [(self.attempt, key, row) for key, row in super().close()]
+
+class MaterialChunkPreview:
+    """Preview "rows" của Material List chia chunk: chunk ≥1 bắt đầu với nhóm chưa biết (MATERIAL_UNKNOWN_KEY),
+    được điền bằng nhóm cuối của các chunk trước nó (giống last_valid_key khi parse output đã nối).
+    Dòng cần nhóm của chunk trước được giữ lại đến khi mọi chunk trước đó xong.
+    Chunk được gọi lại (retry / fallback) thì dòng của lần gọi trước bị bỏ: event "rows_reset" báo client
+    xóa preview đã gửi của chunk đó"""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.last_keys = {}  # chunk -> key (chưa resolve) của dòng cuối
+        self.done = set()
+        self.resolved = []   # key cuối đã resolve của các chunk 0..k đã xong liên tiếp
+        self.pending = {}    # chunk -> [(key, row)] chờ chunk trước
+        self.attempts = {}   # chunk -> số parser đã tạo (mỗi lần gọi model một parser)
+        self.current = {}    # chunk -> lần gọi đang được preview
+        self.emitted = set() # chunk đã gửi ít nhất một event "rows"
+
+    def parser(self, index):
+        """stream_parser cho chunk `index`: mỗi lần gọi model có parser riêng, đánh số lần gọi"""
+        def new_parser():
+            self.attempts[index] = self.attempts.get(index, 0) + 1
+            return MaterialAttemptParser(MATERIAL_DEFAULT_KEY if index == 0 else MATERIAL_UNKNOWN_KEY,
+                                         self.attempts[index])
+        return new_parser
+
+    @staticmethod
+    def _resolve(key, previous):
+        return tuple(part if part is not None else carried for part, carried in zip(key, previous))
+
+    def rows(self, index, rows):
+        if not rows:
+            return
+        attempt = rows[0][0]
+        current = self.current.get(index, attempt)
+        if attempt < current:
+            return  # lần gọi cũ đã bị thay thế
+        if attempt > current:
+            # Lần gọi mới của chunk bắt đầu lại từ dòng đầu: bỏ preview của lần trước
+            self.pending.pop(index, None)
+            self.last_keys.pop(index, None)
+            if index in self.emitted:
+                self.emitted.discard(index)
+                self.emit({"event": "rows_reset", "chunk": index})
+        self.current[index] = attempt
+        rows = [(key, row) for _, key, row in rows]
+        self.last_keys[index] = rows[-1][0]
+        if index <= len(self.resolved):
+            self._emit(index, rows)
+        else:
+            self.pending.setdefault(index, []).extend(rows)
+
+    def finished(self, index):
+        self.done.add(index)
+        while len(self.resolved) in self.done:
+            k = len(self.resolved)
+            if k == 0:
+                self.resolved.append(self.last_keys.get(0, MATERIAL_DEFAULT_KEY))
+            else:
+                self.resolved.append(self._resolve(self.last_keys.get(k, MATERIAL_UNKNOWN_KEY), self.resolved[-1]))
+        for k in sorted(self.pending):
+            if k <= len(self.resolved):
+                self._emit(k, self.pending.pop(k))
+
+    def _emit(self, index, rows):
+        previous = self.resolved[index - 1] if index else None
+        # Gom các dòng liên tiếp cùng nhóm thành một event
+        groups = []
+        for key, row in rows:
+            if previous is not None:
+                key = self._resolve(key, previous)
+            if groups and groups[-1][0] == key:
+                groups[-1][1].append(row)
+            else:
+                groups.append((key, [row]))
+        if groups:
+            self.emitted.add(index)
+        for key, group_rows in groups:
+            self.emit({"event": "rows", "chunk": index, "list_name": key[0], "order_number": key[1],
+                       "data": group_rows})
+
+def parse_material_csv(raw_text):
+    """Hàm thay thế Pandas để parse kết quả từ Gemini Pro CSV sang dạng Array Object JSON"""
+    parser = MaterialCsvParser()
+    for line in material_csv_lines(raw_text):
+        parser.add_line(line)
+    return parser.result()
+
+class JsonArrayStream:
+    """Streaming (Standard Mode): tách từng object JSON hoàn chỉnh trong mảng đang được sinh.
+    Bỏ qua fence ```json; ký tự lạ ngoài object hoặc object không parse được -> MalformedOutputError"""
+
+    def __init__(self):
+        self.state = "start"  # start -> array -> done (hoặc "object" khi output là một object đơn)
+        self._lead = ""       # phần đầu output trước '[' (để bỏ fence)
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _start(self, text):
+        self._lead += text
+        lead = self._lead.lstrip()
+        if lead and "```".startswith(lead):
+            return ""  # "`" / "``": fence có thể bị cắt giữa hai chunk SSE
+        if lead.startswith("```"):
+            newline = lead.find("\n")
+            if newline < 0:
+                if len(lead) > GEMINI_STREAM_MAX_PREAMBLE:
+                    raise MalformedOutputError("Unterminated code fence at start of output.")
+                return ""
+            lead = lead[newline + 1:].lstrip()
+        if not lead:
+            return ""
+        if lead[0] == "[":
+            self.state = "array"
+            return lead[1:]
+        if lead[0] == "{":
+            self.state = "object"
+            return lead
+        raise MalformedOutputError(f"Expected a JSON array, got {lead[:40]!r}.")
+
+    def feed(self, text):
+        """Trả về list các object vừa hoàn chỉnh"""
+        items = []
+        if self.state == "start":
+            text = self._start(text)
+        for ch in text:
+            if self.state == "done":
+                break
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+                    self._buffer = [ch]
+                elif ch == "]" and self.state == "array":
+                    self.state = "done"
+                elif not (ch.isspace() or (ch == "," and self.state == "array")):
+                    raise MalformedOutputError(f"Unexpected {ch!r} between JSON objects.")
+                continue
+
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        items.append(json.loads("".join(self._buffer)))
+                    except ValueError as e:
+                        raise MalformedOutputError(f"Invalid JSON object in output: {e}")
+                    self._buffer = []
+                    if self.state == "object":
+                        self.state = "done"
+        return items
+
+    def close(self):
+        return []
+
+# Dấu nối range: "-", "--", "-->", "->", "=>", "→", "–", "—", "~", "đến" (có thể có khoảng trắng hai bên)
+ORDER_RANGE_SEPARATOR = re.compile(r"\s*(?:-+>?|=>|→|–|—|~|\bđến\b)\s*", re.IGNORECASE)
+ORDER_LIST_SEPARATOR = re.compile(r"[,;\s]+|\bvà\b|&", re.IGNORECASE)
+ORDER_CODE = re.compile(r"^(?P<prefix>.*?)(?P<num>\d+)$")
+ORDER_RANGE = re.compile(r"^(?P<start>[^-]*\d+)-(?P<end>[^-]*\d+)$")
+ORDER_PREFIX_ONLY = re.compile(r"^\d+[^\W\d_]+$")  # "26D" trong "26D 486-489"
+ORDER_ALPHA_PREFIX = re.compile(r"^[^\W\d_]+$")    # "CT" trong "CT 01, 02"
+ORDER_LABEL = re.compile(r"^(?:no|nos|nr|số|so|sn|mã|ma|code|stt)$", re.IGNORECASE)
+
+ORDER_RANGES_REJECTED = Counter(
+    "extractor_order_ranges_rejected_total", "Order-number ranges left unexpanded by guard limits.", ("reason",)
+)
+METRICS.append(ORDER_RANGES_REJECTED)
+
+def expand_order_numbers(value):
+    """Mở rộng mã số (prefix, range, mũi tên) thành list đầy đủ.
+    "25B827, 828, 621" -> [25B827, 25B828, 25B621]; "25B834-838" / "25B834-->38" -> 25B834..25B838;
+    "CT 01, 02" -> [CT 01, CT 02]. Chỉ số cuối của range được mượn chữ số đầu; mã trong list chỉ mượn prefix
+    khi cùng số chữ số với mã trước ("25B827, 5" giữ "5"). Nhãn ("No.", "S/N") bị bỏ;
+    token có nhiều dấu nối ("25B834-838-840") giữ nguyên"""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        value = ", ".join(str(v) for v in value if v is not None)
+    raw = str(value).strip()
+    text = ORDER_RANGE_SEPARATOR.sub("-", raw)
+    tokens = [t for t in ORDER_LIST_SEPARATOR.split(text) if t and t.strip("-")]
+    if not any(ch.isdigit() for ch in text):
+        # Không có mã số nào: giữ nguyên text gốc (một dòng) thay vì tách thành từng từ
+        return [raw] if tokens else []
+    # Nhãn ("No.", "S/N", "Số") không phải mã; từ chỉ có chữ cái ("CT", "MBA") là prefix của số phía sau
+    tokens = [t for t in tokens if any(ch.isdigit() for ch in t)
+              or (ORDER_ALPHA_PREFIX.match(t) and not ORDER_LABEL.match(t))]
+
+    codes = []
+    prefix, last_num = "", ""
+    pending_prefix, pending_joiner = None, ""
+
+    def resolve(token):
+        """(prefix, số) của một mã; số không có prefix chỉ mượn prefix của mã trước khi cùng số chữ số"""
+        nonlocal prefix, last_num
+        m = ORDER_CODE.match(token)
+        num = m.group("num")
+        if m.group("prefix"):
+            prefix = m.group("prefix")
+        elif not last_num or len(num) != len(last_num):
+            # "25B827, 5" / "1234, 56": không đoán prefix hay chữ số đầu
+            prefix = ""
+        last_num = num
+        return prefix, num
+
+    for token in tokens:
+        if pending_prefix is not None:
+            if token[0].isdigit():
+                token = pending_prefix + pending_joiner + token
+            elif not pending_joiner:
+                # "26D" đứng riêng vẫn là một mã; từ chữ cái đứng riêng thì bỏ
+                codes.append(pending_prefix)
+            pending_prefix = None
+        if ORDER_PREFIX_ONLY.match(token):
+            pending_prefix, pending_joiner = token, ""
+            continue
+        if ORDER_ALPHA_PREFIX.match(token):
+            pending_prefix, pending_joiner = token, " "
+            continue
+
+        if token.count("-") > 1:
+            ORDER_RANGES_REJECTED.inc(reason="malformed")
+            print(f"    Order range '{token}' not expanded (malformed).")
+            codes.append(token)
+            continue
+
+        m = ORDER_RANGE.match(token)
+        end_match = ORDER_CODE.match(m.group("end")) if m else None
+        if end_match:
+            start_prefix, start_num = resolve(m.group("start"))
+            end_prefix, end_num = end_match.group("prefix") or start_prefix, end_match.group("num")
+            if len(end_num) < len(start_num):
+                # Số cuối viết tắt: "25B834-38" -> 25B838
+                end_num = start_num[:len(start_num) - len(end_num)] + end_num
+            last_num = end_num
+            first, last = int(start_num), int(end_num)
+            width = len(start_num)
+            if end_prefix != start_prefix:
+                reason = "prefix_mismatch"
+            elif last < first:
+                reason = "descending"
+            elif last - first > ORDER_RANGE_MAX_SPAN:
+                reason = "span"
+            elif len(codes) + last - first + 1 > ORDER_NUMBERS_MAX:
+                reason = "total"
+            else:
+                codes.extend(f"{start_prefix}{n:0{width}d}" for n in range(first, last + 1))
+                continue
+            ORDER_RANGES_REJECTED.inc(reason=reason)
+            print(f"    Order range '{token}' not expanded ({reason}).")
+            codes.append(token)
+        elif ORDER_CODE.match(token):
+            code_prefix, num = resolve(token)
+            codes.append(code_prefix + num)
+        else:
+            codes.append(token)
+
+    if pending_prefix is not None and not pending_joiner:
+        codes.append(pending_prefix)
+    return codes[:ORDER_NUMBERS_MAX]
 
 def flatten_data(data):
     """Hàm xử lý tách dòng (Post-processing) dành cho Hóa đơn/Chứng từ"""
@@ -291,7 +1867,10 @@ def flatten_data(data):
             continue  # Bỏ qua dòng này hoàn toàn
 
         order_nums = item.get('order_numbers', [])
-        
+        # ORDER_NUMBER_EXPANSION=model: mảng model đã liệt kê được giữ nguyên như trước
+        if ORDER_NUMBER_EXPANSION == "server" and isinstance(order_nums, (list, str)):
+            order_nums = expand_order_numbers(order_nums)
+
         if isinstance(order_nums, list) and len(order_nums) > 0:
             def get_val(key):
                 v = item.get(key)
@@ -324,178 +1903,1450 @@ def flatten_data(data):
             
     return flattened
 
+async def lookup_page_cache(img_part, index, model_name, system_prompt):
+    """Trả về (page_key, cached_page_data) — cả hai là None khi cache tắt"""
+    if PAGE_CACHE is None:
+        return None, None
+    page_key = page_cache_key(img_part, model_name, system_prompt)
+    cached = await asyncio.to_thread(PAGE_CACHE.get, page_key)
+    if cached is not None:
+        print(f"    Page {index+1}: cache hit.")
+    return page_key, cached
+
+async def process_single_page(img_part, index, system_prompt, target_url, model_name, doc_id=None,
+                              lookup_cache=True):
+    """Gửi một trang (Standard Mode) tới Gemini, trả về (page_data, error).
+    lookup_cache=False khi caller đã tra page cache (trang đi qua PagePacker), để không đếm miss hai lần"""
+    if lookup_cache:
+        page_key, cached = await lookup_page_cache(img_part, index, model_name, system_prompt)
+        if cached is not None:
+            return cached, None
+    else:
+        page_key = page_cache_key(img_part, model_name, system_prompt) if PAGE_CACHE is not None else None
+
+    payload = {
+        "contents": [{
+            "parts": [{"text": system_prompt}, img_part]
+        }],
+        "generationConfig": {
+            "temperature": 0.1,
+            "response_mime_type": "application/json"
+        }
+    }
+    mode = CURRENT_MODE.get()
+    PAYLOAD_BYTES.inc(len(img_part["inline_data"]["data"]) + len(system_prompt), mode=mode, model=model_name)
+    preview = ROW_PREVIEW.get()
+    on_items = None
+    if preview is not None:
+        def on_items(items):
+            preview({"event": "rows", "page": index + 1, "data": flatten_data(items)})
+    try:
+        raw_response, served_model = await routed_generate(
+            target_url, payload, model_name, doc_id=doc_id, timeout=GEMINI_TIMEOUT_FLASH,
+            stream_parser=JsonArrayStream, on_items=on_items,
+        )
+    except MalformedOutputError as e:
+        return None, f"Page {index+1} JSON Parse Error: {e.detail} (response cancelled)"
+    except GeminiAPIError as e:
+        return None, f"Page {index+1} API Error: {e.detail}"
+    except httpx.HTTPError as e:
+        return None, f"Page {index+1} API Error: {type(e).__name__}: {e}"
+    RESPONSE_CHARS.inc(len(raw_response), mode=mode, model=served_model)
+
+    try:
+        clean_text = raw_response.replace("```json", "").replace("```", "").strip()
+        with span("parse", model=served_model, page=index + 1):
+            page_data = json.loads(clean_text)
+
+        if isinstance(page_data, dict):
+            page_data = [page_data]
+    except Exception as e:
+        return None, f"Page {index+1} JSON Parse Error: {str(e)}"
+
+    if page_key:
+        # Kết quả từ model dự phòng được cache theo key của chính model đó
+        if served_model != model_name:
+            page_key = page_cache_key(img_part, served_model, system_prompt)
+        await asyncio.to_thread(PAGE_CACHE.put, page_key, page_data)
+    return page_data, None
+
+async def process_page_pack(batch, system_prompt, target_url, model_name, doc_id=None):
+    """Gửi nhiều trang trong một request (prompt chỉ gửi 1 lần), tách kết quả theo field "page".
+    batch: list[(index, img_part)] -> {index: (page_data, error)}. Lỗi -> gọi lại từng trang.
+    Các trang trong batch đã được tra page cache (miss) trước khi vào pack."""
+    if len(batch) == 1:
+        index, img_part = batch[0]
+        return {index: await process_single_page(
+            img_part, index, system_prompt, target_url, model_name, doc_id, lookup_cache=False
+        )}
+
+    parts = [{"text": system_prompt + STANDARD_PACKED_NOTE.format(count=len(batch))}]
+    for number, (_, img_part) in enumerate(batch, start=1):
+        parts += [{"text": f"Image {number}:"}, img_part]
+    payload = {
+        "contents": [{"parts": parts}],
+        "generationConfig": {
+            "temperature": 0.1,
+            "response_mime_type": "application/json"
+        }
+    }
+    mode = CURRENT_MODE.get()
+    first_page, last_page = batch[0][0] + 1, batch[-1][0] + 1
+    PAYLOAD_BYTES.inc(
+        sum(len(img_part["inline_data"]["data"]) for _, img_part in batch) + len(parts[0]["text"]),
+        mode=mode, model=model_name,
+    )
+    preview = ROW_PREVIEW.get()
+    on_items = None
+    if preview is not None:
+        def on_items(items):
+            # Tách preview theo field "page" (dòng chưa có / sai "page" chỉ xuất hiện trong kết quả chính thức)
+            by_page = {}
+            for item in items:
+                number = item.get("page") if isinstance(item, dict) else None
+                if isinstance(number, int) and 1 <= number <= len(batch):
+                    by_page.setdefault(batch[number - 1][0], []).append(
+                        {k: v for k, v in item.items() if k != "page"}
+                    )
+            for index, page_items in by_page.items():
+                preview({"event": "rows", "page": index + 1, "data": flatten_data(page_items)})
+
+    try:
+        raw_response, served_model = await routed_generate(
+            target_url, payload, model_name, doc_id=doc_id, timeout=GEMINI_TIMEOUT_FLASH * len(batch),
+            stream_parser=JsonArrayStream, on_items=on_items,
+        )
+        RESPONSE_CHARS.inc(len(raw_response), mode=mode, model=served_model)
+        clean_text = raw_response.replace("```json", "").replace("```", "").strip()
+        with span("parse", model=served_model, pages=f"{first_page}-{last_page}"):
+            rows = json.loads(clean_text)
+        if isinstance(rows, dict):
+            rows = [rows]
+
+        per_page = {index: [] for index, _ in batch}
+        for row in rows:
+            number = int(row.pop("page"))
+            if not 1 <= number <= len(batch):
+                raise ValueError(f"page {number} out of range")
+            per_page[batch[number - 1][0]].append(row)
+    except (GeminiAPIError, httpx.HTTPError, ValueError, TypeError, KeyError, AttributeError) as e:
+        print(f"    Pages {first_page}-{last_page} packed call failed ({type(e).__name__}: {str(e)[:120]}), "
+              f"falling back to per-page calls.")
+        results = await asyncio.gather(*(
+            process_single_page(img_part, index, system_prompt, target_url, model_name, doc_id, lookup_cache=False)
+            for index, img_part in batch
+        ))
+        return {index: result for (index, _), result in zip(batch, results)}
+
+    results = {index: (page_data, None) for index, page_data in per_page.items()}
+    # Trang không có dòng nào trong pack có thể do model bỏ sót ảnh đó: hỏi lại riêng từng trang
+    # (kết quả rỗng của pack không được cache)
+    missing = [(index, img_part) for index, img_part in batch if not per_page[index]]
+    if missing:
+        print(f"    Pages {[index + 1 for index, _ in missing]} had no rows in the packed response, retrying per page.")
+        retried = await asyncio.gather(*(
+            process_single_page(img_part, index, system_prompt, target_url, model_name, doc_id, lookup_cache=False)
+            for index, img_part in missing
+        ))
+        results.update({index: result for (index, _), result in zip(missing, retried)})
+
+    if PAGE_CACHE is not None:
+        for index, img_part in batch:
+            if per_page[index]:
+                await asyncio.to_thread(
+                    PAGE_CACHE.put, page_cache_key(img_part, served_model, system_prompt), per_page[index]
+                )
+    return results
+
+class PagePacker:
+    """Gom các trang đã render thành pack (tối đa max_pages trang / max_bytes) rồi gửi bằng flush_fn.
+    Pack cuối được gửi khi mọi trang đã được quyết định (đã nộp, bị triage hoặc lấy từ cache)."""
+
+    def __init__(self, total_pages, flush_fn, max_pages, max_bytes):
+        self.undecided = total_pages
+        self.flush_fn = flush_fn
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.pending = []  # (index, img_part, future)
+        self.pending_bytes = 0
+        self.tasks = []
+
+    def submit(self, index, img_part):
+        size = len(img_part["inline_data"]["data"])
+        if self.pending and self.pending_bytes + size > self.max_bytes:
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((index, img_part, future))
+        self.pending_bytes += size
+        self.decided()
+        if len(self.pending) >= self.max_pages:
+            self.flush()
+        return future
+
+    def decided(self):
+        self.undecided -= 1
+        if self.undecided <= 0 and self.pending:
+            self.flush()
+
+    def flush(self):
+        batch, self.pending, self.pending_bytes = self.pending, [], 0
+        self.tasks.append(asyncio.create_task(self._run(batch)))
+
+    async def _run(self, batch):
+        try:
+            results = await self.flush_fn([(index, img_part) for index, img_part, _ in batch])
+        except Exception as e:
+            results = {index: (None, f"Page {index+1} Error: {str(e)}") for index, _, _ in batch}
+        for index, _, future in batch:
+            if not future.done():
+                future.set_result(results[index])
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+def mode_config(mode):
+    """Trả về (system_prompt, target_url, model_name) theo mode"""
+    if mode == "material_list":
+        return MATERIAL_LIST_PROMPT, GEMINI_URL_PRO, GEMINI_MODEL_PRO
+    if ORDER_NUMBER_EXPANSION == "server":
+        return STANDARD_PROMPT_RAW_ORDERS, GEMINI_URL_FLASH, GEMINI_MODEL_FLASH
+    return STANDARD_PROMPT, GEMINI_URL_FLASH, GEMINI_MODEL_FLASH
+
+async def iter_standard_pages(upload, filename, doc_id):
+    """Async generator (Standard Mode): yield (index, page_data, error, skip) ngay khi từng trang xong.
+    skip là None hoặc {"page", "reason": "blank" | "duplicate", "duplicate_of"} khi trang bị triage"""
+    system_prompt, target_url, model_name = mode_config("standard")
+    pdf_path = None
+    packer = None
+    tasks = []
+    try:
+        if filename.lower().endswith(".pdf"):
+            # Các worker process render từng trang thẳng từ file upload đã spool (không copy PDF cho mỗi trang)
+            pdf_path = upload.path
+            total_pages = await asyncio.to_thread(pdf_page_count, pdf_path)
+            if total_pages == 0:
+                raise Exception("PDF has no pages.")
+            print(f"   Streaming {total_pages} PDF pages to {model_name}...")
+            image_parts = None
+        else:
+            # NORMAL IMAGE HANDLING
+            with span("encode_image", model=model_name):
+                img_part, info = await run_cpu_bound(encode_image, upload.path, filename, CURRENT_PROFILE.get())
+            record_encoding(info)
+            image_parts = [img_part]
+            total_pages = 1
+
+        print(f"--> Calling {model_name} concurrently (up to {PAGE_CONCURRENCY} pages in flight)...")
+
+        # Pipeline: mỗi trang được render trong process pool rồi gửi ngay khi xong. Semaphore được
+        # giữ từ lúc render đến khi Gemini trả về, nên tối đa PAGE_CONCURRENCY request (trang hoặc pack)
+        # nằm trong RAM.
+        packer = None
+        if pdf_path and PACK_PAGES > 1 and total_pages > 1:
+            packer = PagePacker(
+                total_pages,
+                lambda batch: process_page_pack(batch, system_prompt, target_url, model_name, doc_id),
+                PACK_PAGES, PACK_MAX_BYTES,
+            )
+        page_semaphore = asyncio.Semaphore(PAGE_CONCURRENCY * (PACK_PAGES if packer else 1))
+
+        def mark_decided():
+            if packer is not None:
+                packer.decided()
+
+        async def fetch_page(index, img_part):
+            if packer is None:
+                return await process_single_page(img_part, index, system_prompt, target_url, model_name, doc_id)
+            _, cached = await lookup_page_cache(img_part, index, model_name, system_prompt)
+            if cached is not None:
+                mark_decided()
+                return cached, None
+            return await packer.submit(index, img_part)
+        # Triage: (content hash, dhash, index, future kết quả) của các trang đã gửi đi, để phát hiện trang trùng
+        seen_pages = []
+
+        def find_duplicate(content_hash, dhash):
+            for seen_content, seen_dhash, seen_index, seen_future in seen_pages:
+                if seen_content == content_hash:
+                    return seen_index, seen_future
+                if TRIAGE_DUP_MAX_DISTANCE >= 0 and bin(seen_dhash ^ dhash).count("1") <= TRIAGE_DUP_MAX_DISTANCE:
+                    return seen_index, seen_future
+            return None
+
+        async def run_page(index):
+            with span("page", model=model_name, doc_id=doc_id, page=index + 1):
+                async with page_semaphore:
+                    features = None
+                    if pdf_path:
+                        try:
+                            with span("render", model=model_name, page=index + 1):
+                                img_part, features, info = await run_cpu_bound(
+                                    render_pdf_page_part, pdf_path, index, CURRENT_PROFILE.get()
+                                )
+                            record_encoding(info)
+                        except Exception as e:
+                            mark_decided()
+                            return index, None, f"Page {index+1} Render Error: {str(e)}", None
+                    else:
+                        img_part = image_parts[index]
+
+                    duplicate = None
+                    if features is not None:
+                        if is_blank_page(features):
+                            print(f"    Page {index+1}: blank, skipped.")
+                            mark_decided()
+                            return index, None, None, {"page": index + 1, "reason": "blank"}
+                        content_hash = sha256_hex(img_part["inline_data"]["data"])
+                        duplicate = find_duplicate(content_hash, features["dhash"])
+
+                    if duplicate is None:
+                        result_future = asyncio.get_running_loop().create_future()
+                        if features is not None:
+                            seen_pages.append((content_hash, features["dhash"], index, result_future))
+                        try:
+                            page_data, err = await fetch_page(index, img_part)
+                        except BaseException:
+                            result_future.set_result((None, None))
+                            raise
+                        result_future.set_result((page_data, err))
+                        return index, page_data, err, None
+                    mark_decided()
+
+                # Trang trùng: chờ kết quả của trang gốc (ngoài semaphore) thay vì gọi model lần nữa
+                original_index, original_future = duplicate
+                skip = {"page": index + 1, "reason": "duplicate", "duplicate_of": original_index + 1}
+                print(f"    Page {index+1}: duplicate of page {original_index+1}.")
+                if TRIAGE_DUPLICATE_ACTION == "drop":
+                    return index, None, None, skip
+                page_data, _ = await asyncio.shield(original_future)
+                return index, copy.deepcopy(page_data), None, skip
+
+        tasks = [asyncio.create_task(run_page(idx)) for idx in range(total_pages)]
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        if packer is not None:
+            packer.cancel()
+
+async def extract_standard(upload, filename, doc_id):
+    """Standard Mode: trả về (all_extracted_data, error_logs, skipped_pages) theo ĐÚNG THỨ TỰ trang"""
+    page_results = {}
+    async with aclosing(iter_standard_pages(upload, filename, doc_id)) as pages:
+        async for index, page_data, err, skip in pages:
+            page_results[index] = (page_data, err, skip)
+
+    all_extracted_data = []
+    error_logs = []
+    skipped_pages = []
+    for index in sorted(page_results):
+        page_data, err, skip = page_results[index]
+        if skip:
+            skipped_pages.append(skip)
+        if err:
+            error_logs.append(err)
+            print(f"    {err}")
+        elif page_data:
+            all_extracted_data.extend(page_data)
+    return all_extracted_data, error_logs, skipped_pages
+
+async def extract_material_list(upload, filename, doc_id):
+    """Material List Mode (Pro): PDF dài được tách thành chunk gọi song song rồi nối lại,
+    trả về danh sách nhóm đã parse"""
+    system_prompt, target_url, model_name = mode_config("material_list")
+    emit = ROW_PREVIEW.get()
+    preview = MaterialChunkPreview(emit) if emit is not None else None
+
+    async def call_chunk(image_parts, index):
+        prompt = system_prompt if index == 0 else system_prompt + MATERIAL_LIST_CHUNK_NOTE
+        PAYLOAD_BYTES.inc(
+            sum(inline_part_size(part) for part in image_parts) + len(prompt),
+            mode="material_list", model=model_name,
+        )
+        payload = {
+            "contents": [{
+                "parts": [{"text": prompt}] + image_parts
+            }],
+            "generationConfig": {
+                "temperature": 0.1,
+                "response_mime_type": "text/plain"
+            }
+        }
+        on_items = None
+        start_key = MATERIAL_DEFAULT_KEY if index == 0 else MATERIAL_UNKNOWN_KEY
+        stream_parser = lambda: MaterialCsvParser(start_key)
+        if preview is not None:
+            stream_parser = preview.parser(index)
+
+            def on_items(rows):
+                preview.rows(index, rows)
+        try:
+            text, _ = await routed_generate(
+                target_url, payload, model_name, doc_id=doc_id, timeout=GEMINI_TIMEOUT_PRO,
+                stream_parser=stream_parser, on_items=on_items,
+            )
+            if preview is not None:
+                preview.finished(index)
+            return text
+        except GeminiAPIError as e:
+            raise HTTPException(status_code=e.status_code, detail=f"Gemini API Error: {e.detail}")
+
+    # Chunk PDF nằm trong thư mục tạm; base64 của chúng được stream khi gửi request (FileData)
+    with tempfile.TemporaryDirectory(prefix="material_chunks_") as chunk_dir:
+        if filename.lower().endswith(".pdf"):
+            # PRO MODE: Pass Raw PDF Bytes directly for reasoning
+            with span("split_pdf", model=model_name):
+                chunks = await run_cpu_bound(split_pdf_chunks, upload.path, MATERIAL_CHUNK_PAGES, chunk_dir)
+            print(f"   Using {model_name} with direct PDF upload ({len(chunks)} chunk(s)).")
+            chunk_parts = [[make_file_part(chunk, "application/pdf")] for chunk in chunks]
+        else:
+            with span("encode_image", model=model_name):
+                img_part, info = await run_cpu_bound(encode_image, upload.path, filename, CURRENT_PROFILE.get())
+            record_encoding(info)
+            chunk_parts = [[img_part]]
+
+        print(f"--> Calling {model_name}...")
+        tasks = [asyncio.create_task(call_chunk(parts, idx)) for idx, parts in enumerate(chunk_parts)]
+        try:
+            raw_chunks = await asyncio.gather(*tasks)
+        finally:
+            # Một chunk lỗi (hoặc request bị hủy): dừng các chunk còn lại và chờ chúng kết thúc
+            # trước khi thư mục chunk bị xóa
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    raw_response = raw_chunks[0] if len(raw_chunks) == 1 else stitch_material_csv(raw_chunks)
+
+    print(f"--> Response received ({len(raw_response)} chars).")
+    RESPONSE_CHARS.inc(len(raw_response), mode="material_list", model=model_name)
+    with span("parse", model=model_name):
+        return parse_material_csv(raw_response)
+
+async def lookup_cached_result(upload, mode):
+    """Trả về (cache_key, cached_data) — cached_data là None nếu miss hoặc cache tắt"""
+    if RESULT_CACHE is None:
+        return None, None
+    system_prompt, _, model_name = mode_config(mode)
+    cache_key = result_cache_key(upload.digest, mode, model_name, system_prompt, CURRENT_PROFILE.get())
+    return cache_key, await asyncio.to_thread(RESULT_CACHE.get, cache_key)
+
+# --- EXPORT (CSV / XLSX) ---
+
+# Cột export Standard Mode theo thứ tự bảng trên UI (App.jsx): (key trong dữ liệu, tiêu đề cột)
+STANDARD_EXPORT_COLUMNS = [
+    ("stt", "STT"), ("source_file", "Tệp nguồn"), ("doc_type", "Loại chứng từ"), ("date", "Ngày"),
+    ("id", "Số phiếu"), ("name", "Người giao/Đơn vị"), ("description", "Tên"), ("order_numbers", "Mã Code"),
+    ("code", "Mã hàng"), ("unit", "ĐVT"), ("quantity_doc", "SL CTừ"), ("quantity_actual", "SL Thực"),
+    ("unitprice", "Đơn giá"), ("totalprice", "Thành tiền"),
+]
+# Material List: nhóm (Tên bảng, Mã code) thành 2 cột đầu của mỗi dòng, sau đó là header CSV của prompt
+MATERIAL_EXPORT_COLUMNS = [
+    ("source_file", "Tệp nguồn"), ("list_name", "Tên bảng"), ("order_number", "Mã code"),
+] + [(name, name) for name in ["STT", "Tên vật tư", "Quy cách", "ĐVT", "Định mức", "Thực lĩnh", "Chênh lệch", "Ghi chú"]]
+EXPORT_NUMERIC_COLUMNS = {"quantity_doc", "quantity_actual", "unitprice", "totalprice", "Định mức", "Thực lĩnh"}
+
+# Ký tự điều khiển không hợp lệ trong XML 1.0 (model đôi khi trả về)
+XML_INVALID_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def export_number(value):
+    """Giống parseNumber của App.jsx: "3 193" / "20,5" -> số, text không phải số giữ nguyên"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, str):
+        try:
+            number = float(value.replace(" ", "").replace(",", "."))
+        except ValueError:
+            return value
+        # "inf" / "nan" không phải số hợp lệ trong XLSX: giữ nguyên text
+        if not math.isfinite(number):
+            return value
+        value = number
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+def standard_export_rows(rows, source_file, start=1):
+    """Dòng đã flatten (Standard Mode) -> list giá trị theo STANDARD_EXPORT_COLUMNS, STT đánh từ `start`"""
+    values = []
+    for stt, row in enumerate(rows, start):
+        row = {**row, "stt": stt, "source_file": source_file}
+        values.append([
+            export_number(row.get(key)) if key in EXPORT_NUMERIC_COLUMNS else row.get(key)
+            for key, _ in STANDARD_EXPORT_COLUMNS
+        ])
+    return values
+
+def material_export_rows(groups, source_file):
+    """Nhóm của parse_material_csv -> list giá trị theo MATERIAL_EXPORT_COLUMNS (giữ thứ tự nhóm)"""
+    values = []
+    for group in groups:
+        for row in group["data"]:
+            row = {**row, "source_file": source_file, "list_name": group["list_name"],
+                   "order_number": group["order_number"]}
+            values.append([
+                export_number(row.get(key)) if key in EXPORT_NUMERIC_COLUMNS else row.get(key)
+                for key, _ in MATERIAL_EXPORT_COLUMNS
+            ])
+    return values
+
+# Dòng báo lỗi (trang / file không trích xuất được): (cột ghi nhãn "LỖI", cột ghi nội dung lỗi) theo mode
+EXPORT_ERROR_FIELDS = {"standard": ("doc_type", "description"), "material_list": ("list_name", "Tên vật tư")}
+
+def export_error_row(mode, source_file, message):
+    """Dòng lỗi trong file export thay vì bỏ trống phần dữ liệu bị thiếu"""
+    label_key, message_key = EXPORT_ERROR_FIELDS["material_list" if mode == "material_list" else "standard"]
+    columns = MATERIAL_EXPORT_COLUMNS if mode == "material_list" else STANDARD_EXPORT_COLUMNS
+    row = {"source_file": source_file, label_key: "LỖI", message_key: message}
+    return [row.get(key) for key, _ in columns]
+
+class CsvExport:
+    """CSV UTF-8 có BOM (Excel mở đúng tiếng Việt), ghi vào buffer nhỏ được xả dần qua drain()"""
+    media_type = "text/csv; charset=utf-8"
+    extension = "csv"
+
+    def __init__(self, headers, sheet_name=None):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._buffer.write("\ufeff")
+        self._writer.writerow(headers)
+
+    def write_row(self, values):
+        self._writer.writerow(["" if value is None else value for value in values])
+
+    def drain(self, force=False):
+        if not force and self._buffer.tell() < EXPORT_FLUSH_BYTES:
+            return b""
+        data = self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def close(self):
+        return self.drain(force=True)
+
+class _ChunkSink:
+    """File-like không seek được: zipfile ghi vào đây (dùng data descriptor), exporter lấy bytes ra từng đợt"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="xl/workbook.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+    '</Relationships>'
+)
+
+class XlsxExport:
+    """XLSX một sheet, tối giản: zip được ghi tuần tự (zipfile trên stream không seek), ô chữ là inline
+    string nên không cần giữ bảng sharedStrings trong RAM"""
+    media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    extension = "xlsx"
+
+    def __init__(self, headers, sheet_name="Sheet1"):
+        self._sink = _ChunkSink()
+        self._zip = zipfile.ZipFile(self._sink, "w", zipfile.ZIP_DEFLATED)
+        self._zip.writestr("[Content_Types].xml", XLSX_CONTENT_TYPES)
+        self._zip.writestr("_rels/.rels", XLSX_ROOT_RELS)
+        self._zip.writestr("xl/_rels/workbook.xml.rels", XLSX_WORKBOOK_RELS)
+        self._zip.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{xml_escape(sheet_name[:31], {chr(34): "&quot;"})}" sheetId="1" r:id="rId1"/>'
+            '</sheets></workbook>',
+        )
+        self._sheet = self._zip.open("xl/worksheets/sheet1.xml", "w")
+        self._sheet.write(
+            b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+        )
+        self.write_row(headers)
+
+    def write_row(self, values):
+        cells = []
+        for value in values:
+            if value is None or value == "":
+                cells.append("<c/>")
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+                cells.append(f"<c><v>{value}</v></c>")
+            else:
+                text = xml_escape(XML_INVALID_CHARS.sub("", str(value)))
+                cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+        self._sheet.write(("<row>" + "".join(cells) + "</row>").encode("utf-8"))
+
+    def drain(self, force=False):
+        if not force and self._sink.size < EXPORT_FLUSH_BYTES:
+            return b""
+        return self._sink.take()
+
+    def close(self):
+        self._sheet.write(b"</sheetData></worksheet>")
+        self._sheet.close()
+        self._zip.close()
+        return self._sink.take()
+
+EXPORT_FORMATS = {"csv": CsvExport, "xlsx": XlsxExport}
+
+def check_export_format(export_format):
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format '{export_format}'. Use one of {list(EXPORT_FORMATS)}.")
+    return EXPORT_FORMATS[export_format]
+
+def new_export(export_format, mode):
+    """Exporter (đã ghi header) cho mode: Material List giữ nhóm trong cột, Standard có cột STT / Tệp nguồn"""
+    if mode == "material_list":
+        return EXPORT_FORMATS[export_format]([title for _, title in MATERIAL_EXPORT_COLUMNS], "Bảng kê vật tư")
+    return EXPORT_FORMATS[export_format]([title for _, title in STANDARD_EXPORT_COLUMNS], "Trích xuất")
+
+def export_response(body, exporter, filename, release=None):
+    """StreamingResponse tải file: tên file UTF-8 theo RFC 5987"""
+    name = f"{os.path.splitext(filename)[0] or 'export'}.{exporter.extension}"
+    ascii_name = name.encode("ascii", "replace").decode().replace("?", "_").replace('"', "_")
+    headers = {"Content-Disposition": f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name)}"}
+    return StreamingResponse(
+        body, media_type=exporter.media_type, headers=headers,
+        background=BackgroundTask(release) if release else None,
+    )
+
+def write_export_rows(exporter, rows):
+    """Ghi một lô dòng, trả về các chunk đã đủ EXPORT_FLUSH_BYTES"""
+    chunks = []
+    for values in rows:
+        exporter.write_row(values)
+        chunk = exporter.drain()
+        if chunk:
+            chunks.append(chunk)
+    return chunks
+
+async def iter_export(exporter, export_format, source, row_batches):
+    """row_batches: async iterable các list giá trị -> bytes của file export, xả mỗi ~EXPORT_FLUSH_BYTES.
+    Mỗi lô được ghi (nén deflate với XLSX) trong thread để không chặn event loop"""
+    async for rows in row_batches:
+        for chunk in await asyncio.to_thread(write_export_rows, exporter, rows):
+            yield chunk
+        EXPORT_ROWS.inc(len(rows), format=export_format, source=source)
+    yield await asyncio.to_thread(exporter.close)
+
+async def iter_pages_in_order(upload, filename, doc_id):
+    """iter_standard_pages theo ĐÚNG THỨ TỰ trang: trang xong sớm được giữ lại đến khi tới lượt.
+    Yield (index, flattened_rows, error); trang lỗi / bị bỏ qua có rows rỗng"""
+    pending = {}
+    next_index = 0
+    async with aclosing(iter_standard_pages(upload, filename, doc_id)) as pages:
+        async for index, page_data, err, skip in pages:
+            pending[index] = ([] if err else flatten_data(page_data or []), err)
+            while next_index in pending:
+                rows, err = pending.pop(next_index)
+                yield next_index, rows, err
+                next_index += 1
+
+# --- JOB QUEUE ---
+
+class JobStore:
+    """Hàng đợi job bền vững trên SQLite: mỗi job gồm nhiều file, mỗi file là một đơn vị xử lý"""
+
+    def __init__(self, db_path, spool_dir):
+        self.spool_dir = spool_dir
+        os.makedirs(spool_dir, exist_ok=True)
+        # Định danh process này trong cột owner (nhiều process có thể dùng chung DB)
+        self.owner = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, mode TEXT NOT NULL, status TEXT NOT NULL,"
+            " total_files INTEGER NOT NULL, completed_files INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL, started_at REAL, finished_at REAL);"
+            "CREATE TABLE IF NOT EXISTS job_files ("
+            " job_id TEXT NOT NULL, file_index INTEGER NOT NULL, filename TEXT NOT NULL,"
+            " path TEXT, status TEXT NOT NULL, result TEXT, error TEXT,"
+            " PRIMARY KEY (job_id, file_index));"
+            "CREATE INDEX IF NOT EXISTS job_files_status ON job_files (status);"
+        )
+        # DB tạo trước khi có claim theo owner: thêm cột còn thiếu
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(job_files)")}
+        for column, kind in (("owner", "TEXT"), ("claimed_at", "REAL"), ("heartbeat_at", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE job_files ADD COLUMN {column} {kind}")
+        self._db.commit()
+
+    def create(self, mode, uploads):
+        """uploads: list[(filename, SpooledUpload đã spool vào spool_dir)] -> job_id (file được đổi tên, không copy)"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        rows = []
+        for index, (filename, upload) in enumerate(uploads):
+            path = os.path.join(self.spool_dir, f"{job_id}_{index}{os.path.splitext(filename)[1]}")
+            os.replace(upload.path, path)
+            rows.append((job_id, index, filename, path, "queued"))
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, mode, status, total_files, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, mode, len(rows), now),
+            )
+            self._db.executemany(
+                "INSERT INTO job_files (job_id, file_index, filename, path, status) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+        return job_id
+
+    def requeue_stale(self, stale_seconds):
+        """Các file 'running' không còn heartbeat (process giữ claim đã chết / restart) về lại hàng đợi"""
+        with self._lock:
+            count = self._db.execute(
+                "UPDATE job_files SET status = 'queued', owner = NULL"
+                " WHERE status = 'running' AND COALESCE(heartbeat_at, 0) < ?",
+                (time.time() - stale_seconds,),
+            ).rowcount
+            self._db.commit()
+        return count
+
+    def heartbeat(self):
+        """Gia hạn claim của các file process này đang xử lý"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE job_files SET heartbeat_at = ? WHERE owner = ? AND status = 'running'",
+                (time.time(), self.owner),
+            )
+            self._db.commit()
+
+    def claim_next(self):
+        """Claim nguyên tử (một câu UPDATE ... RETURNING): hai process không thể lấy cùng một file"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "UPDATE job_files SET status = 'running', owner = ?, claimed_at = ?, heartbeat_at = ?"
+                " WHERE status = 'queued' AND rowid = ("
+                "  SELECT f.rowid FROM job_files f JOIN jobs j ON j.id = f.job_id WHERE f.status = 'queued'"
+                "  ORDER BY j.created_at, f.file_index LIMIT 1)"
+                " RETURNING job_id, file_index, filename, path",
+                (self.owner, now, now),
+            ).fetchone()
+            if row is None:
+                self._db.commit()
+                return None
+            mode = self._db.execute(
+                "UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, ?) WHERE id = ? RETURNING mode",
+                (now, row[0]),
+            ).fetchone()[0]
+            self._db.commit()
+        return (*row, mode)
+
+    def finish_file(self, job_id, file_index, status, result=None, error=None):
+        """Ghi kết quả nếu process này vẫn giữ claim; False khi claim đã bị requeue cho process khác"""
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE job_files SET status = ?, result = ?, error = ?, path = NULL"
+                " WHERE job_id = ? AND file_index = ? AND owner = ? AND status = 'running'",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, job_id, file_index, self.owner),
+            ).rowcount
+            if not updated:
+                self._db.commit()
+                return False
+            self._db.execute(
+                "UPDATE jobs SET completed_files = completed_files + 1 WHERE id = ?", (job_id,)
+            )
+            self._db.execute(
+                "UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND completed_files >= total_files",
+                (time.time(), job_id),
+            )
+            self._db.commit()
+        return True
+
+    def get(self, job_id, with_results=False):
+        with self._lock:
+            job = self._db.execute(
+                "SELECT id, mode, status, total_files, completed_files, created_at, started_at, finished_at"
+                " FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            files = self._db.execute(
+                "SELECT filename, status, error, result FROM job_files WHERE job_id = ? ORDER BY file_index",
+                (job_id,),
+            ).fetchall()
+
+        info = {
+            "job_id": job[0],
+            "mode": job[1],
+            "status": job[2],
+            "total_files": job[3],
+            "completed_files": job[4],
+            "progress": round(job[4] / job[3], 4) if job[3] else 1.0,
+            "created_at": job[5],
+            "started_at": job[6],
+            "finished_at": job[7],
+            "files": [],
+        }
+        for filename, status, error, result in files:
+            entry = {"filename": filename, "status": status, "error": error}
+            if with_results:
+                entry["result"] = json.loads(result) if result else None
+            info["files"].append(entry)
+        return info
+
+    def file_result(self, job_id, file_index):
+        """(filename, status, result đã parse, error) của một file — export đọc lần lượt từng file, không nạp cả job"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT filename, status, result, error FROM job_files WHERE job_id = ? AND file_index = ?",
+                (job_id, file_index),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]) if row[2] else None, row[3]
+
+    def evict_expired(self, ttl_seconds):
+        """Xóa các job đã xong quá hạn lưu giữ (kèm file upload còn sót)"""
+        cutoff = time.time() - ttl_seconds
+        with self._lock:
+            expired = [r[0] for r in self._db.execute(
+                "SELECT id FROM jobs WHERE status = 'done' AND finished_at < ?", (cutoff,)
+            )]
+            for job_id in expired:
+                for (path,) in self._db.execute("SELECT path FROM job_files WHERE job_id = ?", (job_id,)):
+                    if path and os.path.exists(path):
+                        os.unlink(path)
+                self._db.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+                self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._db.commit()
+        return len(expired)
+
+JOB_STORE = JobStore(JOBS_DB_PATH, JOBS_SPOOL_DIR)
+_job_wakeup = None
+
+async def job_worker(worker_id):
+    """Worker nền: lấy từng file trong hàng đợi và chạy run_extraction"""
+    while True:
+        claimed = await asyncio.to_thread(JOB_STORE.claim_next)
+        if claimed is None:
+            try:
+                await asyncio.wait_for(_job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            _job_wakeup.clear()
+            continue
+
+        job_id, file_index, filename, path, mode = claimed
+        print(f"--> [job worker {worker_id}] {job_id} file {file_index+1}: {filename} | Mode: {mode}")
+        result, error = None, None
+        try:
+            upload = await asyncio.to_thread(SpooledUpload.from_path, path)
+            # Job không bị từ chối khi hết budget: chờ tới lượt
+            async with UPLOAD_BUDGET.reserve(upload.size):
+                # Dùng job_id làm doc_id: cả batch chia sẻ một lượt round-robin trong scheduler
+                result = await run_extraction(upload, filename, mode, f"job:{job_id}")
+            status = "failed" if result.get("error") and not result.get("data") else "done"
+            error = result.get("error")
+        except HTTPException as e:
+            status, error = "failed", str(e.detail)
+        except Exception as e:
+            status, error = "failed", str(e)
+
+        owned = await asyncio.to_thread(JOB_STORE.finish_file, job_id, file_index, status, result, error)
+        if not owned:
+            # Claim đã hết hạn và được giao cho worker khác: file spool thuộc về worker đó
+            print(f"--> [job worker {worker_id}] {job_id} file {file_index+1}: claim lost, result discarded.")
+        elif os.path.exists(path):
+            os.unlink(path)
+
+async def job_heartbeat():
+    """Gia hạn claim của process này và trả về hàng đợi các claim đã chết (của bất kỳ process nào)"""
+    while True:
+        await asyncio.to_thread(JOB_STORE.heartbeat)
+        requeued = await asyncio.to_thread(JOB_STORE.requeue_stale, JOB_CLAIM_STALE_SECONDS)
+        if requeued:
+            print(f"--> Requeued {requeued} stale job files.")
+            _job_wakeup.set()
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+
+async def job_janitor():
+    while True:
+        evicted = await asyncio.to_thread(JOB_STORE.evict_expired, JOB_RESULT_TTL_SECONDS)
+        if evicted:
+            print(f"--> Evicted {evicted} expired jobs.")
+        await asyncio.sleep(3600)
+
+# --- APP ---
+
+@asynccontextmanager
+async def lifespan(app):
+    """Tài nguyên dùng chung của process: mở khi server khởi động, đóng khi tắt"""
+    global _job_wakeup
+    get_http_client()
+    _job_wakeup = asyncio.Event()
+    job_tasks = [asyncio.create_task(job_heartbeat()), asyncio.create_task(job_janitor())]
+    job_tasks += [asyncio.create_task(job_worker(worker_id)) for worker_id in range(JOB_WORKERS)]
+    try:
+        yield
+    finally:
+        # Dừng job worker trước khi đóng client / pool chúng đang dùng. File đang chạy dở giữ claim,
+        # hết heartbeat thì được requeue_stale trả lại hàng đợi
+        for task in job_tasks:
+            task.cancel()
+        await asyncio.gather(*job_tasks, return_exceptions=True)
+        await close_http_client()
+        GEMINI_SCHEDULER.close()
+        shutdown_render_pool()
+
+# Initialize FastAPI
+app = FastAPI(lifespan=lifespan)
+
+# CORS Configuration
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 @app.get("/")
 def read_root():
     return {"status": "Online", "message": "Server is running."}
 
+@app.get("/cache/stats")
+def cache_stats():
+    if RESULT_CACHE is None:
+        return {"enabled": False}
+    return {"enabled": True, "results": RESULT_CACHE.snapshot(), "pages": PAGE_CACHE.snapshot()}
+
+@app.get("/scheduler/stats")
+def scheduler_stats():
+    return {**GEMINI_SCHEDULER.snapshot(), "uploads": UPLOAD_BUDGET.snapshot()}
+
+@app.get("/router/stats")
+def router_stats():
+    return MODEL_ROUTER.snapshot()
+
+@app.get("/gemini/stats")
+def gemini_stats():
+    models = {}
+    for model, stats in GEMINI_CALL_STATS.items():
+        models[model] = {
+            **stats,
+            "latency_p50_seconds": GEMINI_LATENCY.percentile(model, 0.5),
+            "latency_p95_seconds": GEMINI_LATENCY.percentile(model, 0.95),
+            "latency_p99_seconds": GEMINI_LATENCY.percentile(model, 0.99),
+        }
+    return {"hedging_enabled": GEMINI_HEDGE_ENABLED, "models": models}
+
+def render_metrics():
+    """Xuất toàn bộ metrics theo Prometheus text format (kèm các gauge lấy tại thời điểm scrape)"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    scheduler = GEMINI_SCHEDULER.snapshot()
+    lines += [
+        "# HELP extractor_gemini_in_flight Gemini calls currently in flight.",
+        "# TYPE extractor_gemini_in_flight gauge",
+        f"extractor_gemini_in_flight {scheduler['in_flight']}",
+        "# HELP extractor_gemini_queued Gemini calls waiting in the scheduler.",
+        "# TYPE extractor_gemini_queued gauge",
+    ]
+    for model, model_stats in scheduler["models"].items():
+        lines.append(f"extractor_gemini_queued{_format_labels(('model',), (model,))} {model_stats['queued']}")
+
+    lines += [
+        "# HELP extractor_circuit_open 1 while the model's circuit breaker is open.",
+        "# TYPE extractor_circuit_open gauge",
+    ]
+    for model, breaker in MODEL_ROUTER.breakers.items():
+        lines.append(f"extractor_circuit_open{_format_labels(('model',), (model,))} {int(breaker.state() == 'open')}")
+
+    for field in ("attempts", "retries", "hedged", "hedge_wins", "failures"):
+        name = f"extractor_gemini_{field}_total"
+        lines += [f"# HELP {name} Gemini call {field.replace('_', ' ')}.", f"# TYPE {name} counter"]
+        for model, stats in GEMINI_CALL_STATS.items():
+            lines.append(f"{name}{_format_labels(('model',), (model,))} {stats[field]}")
+
+    budget = UPLOAD_BUDGET.snapshot()
+    lines += [
+        "# HELP extractor_upload_in_flight_bytes Upload bytes currently admitted for processing.",
+        "# TYPE extractor_upload_in_flight_bytes gauge",
+        f"extractor_upload_in_flight_bytes {budget['in_flight_bytes']}",
+        "# HELP extractor_upload_waiting Uploads waiting for the in-flight byte budget.",
+        "# TYPE extractor_upload_waiting gauge",
+        f"extractor_upload_waiting {budget['waiting']}",
+        "# HELP extractor_upload_rejected_total Uploads rejected with 503 by the in-flight byte budget.",
+        "# TYPE extractor_upload_rejected_total counter",
+        f"extractor_upload_rejected_total {budget['rejected']}",
+    ]
+
+    if RESULT_CACHE is not None:
+        lines += [
+            "# HELP extractor_cache_lookups_total Cache lookups by tier and result.",
+            "# TYPE extractor_cache_lookups_total counter",
+        ]
+        for cache_name, cache in (("results", RESULT_CACHE), ("pages", PAGE_CACHE)):
+            for field in ("memory_hits", "disk_hits", "misses"):
+                labels = _format_labels(("cache", "result"), (cache_name, field))
+                lines.append(f"extractor_cache_lookups_total{labels} {cache.stats[field]}")
+        lines += [
+            "# HELP extractor_cache_disk_errors_total SQLite cache errors ignored (lookup served as a miss).",
+            "# TYPE extractor_cache_disk_errors_total counter",
+        ]
+        for cache_name, cache in (("results", RESULT_CACHE), ("pages", PAGE_CACHE)):
+            lines.append(f"extractor_cache_disk_errors_total{_format_labels(('cache',), (cache_name,))} "
+                         f"{cache.stats['disk_errors']}")
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.delete("/cache")
+def cache_clear():
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.clear()
+        PAGE_CACHE.clear()
+    return {"status": "cleared"}
+
+async def admit_upload(file):
+    """Spool upload + admission theo UPLOAD_BUDGET trước khi trả header (request bị từ chối nhận 503 thật).
+    Trả về (upload, release): release trả budget + xóa file spool, gọi nhiều lần (generator lẫn background
+    task) chỉ chạy một lần"""
+    upload = await spool_upload(file)
+    try:
+        await UPLOAD_BUDGET.acquire(upload.size, INFLIGHT_QUEUE_SECONDS)
+    except BaseException:
+        await asyncio.to_thread(upload.close)
+        raise
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            UPLOAD_BUDGET.release(upload.size)
+            upload.close()
+
+    return upload, release
+
+def bind_extraction_context(upload, mode, profile=None, deadline=None):
+    """Context của một lần trích xuất (dùng chung cho /extract, /extract/stream, /extract/export và job worker):
+    mode, encoding profile, deadline và list các model đã phục vụ — trả về list đó"""
+    CURRENT_MODE.set(mode)
+    CURRENT_PROFILE.set(profile or ENCODING_PROFILE)
+    CURRENT_DEADLINE.set(deadline)
+    served = []
+    SERVED_MODELS.set(served)
+    INPUT_BYTES.inc(upload.size, mode=mode)
+    return served
+
+async def store_cached_result(cache_key, mode, data, complete=True):
+    """Ghi result cache: chỉ kết quả đầy đủ (không trang lỗi) và do model ưu tiên của mode phục vụ"""
+    _, _, model_name = mode_config(mode)
+    if cache_key and complete and served_by_preferred(model_name):
+        await asyncio.to_thread(RESULT_CACHE.put, cache_key, data)
+
+async def run_extraction(upload, filename, mode, doc_id, profile=None, deadline=None):
+    """Trích xuất đầy đủ một file đã spool (có result cache), trả về body giống /extract"""
+    served = bind_extraction_context(upload, mode, profile, deadline)
+    _, _, model_name = mode_config(mode)
+    outcome = "error"
+    try:
+        with span("request", model=model_name, doc_id=doc_id, filename=filename):
+            result = await _run_extraction(upload, filename, mode, doc_id)
+        if served:
+            result["served_by"] = served
+        outcome = "cached" if result.get("cached") else ("failed" if result.get("error") else "ok")
+        return result
+    finally:
+        REQUESTS_TOTAL.inc(mode=mode, outcome=outcome)
+
+async def _run_extraction(upload, filename, mode, doc_id):
+    _, _, model_name = mode_config(mode)
+
+    # --- RESULT CACHE (cùng file + mode + model + prompt -> trả kết quả ngay) ---
+    with span("cache_lookup", model=model_name):
+        cache_key, cached = await lookup_cached_result(upload, mode)
+    if cached is not None:
+        print(f"--> Cache hit for {filename}.")
+        return {"data": cached, "cached": True}
+
+    # --- CALL GOOGLE API & PROCESS RESULT ---
+    if mode == "material_list":
+        # MATERIAL LIST (PRO MODEL) - One big call
+        processed_data = await extract_material_list(upload, filename, doc_id)
+        await store_cached_result(cache_key, mode, processed_data)
+        return {"data": processed_data}
+
+    # STANDARD MODE (FLASH) - xử lý song song từng trang
+    all_extracted_data, error_logs, skipped_pages = await extract_standard(upload, filename, doc_id)
+    extra = {"skipped_pages": skipped_pages} if skipped_pages else {}
+
+    if not all_extracted_data and error_logs:
+        return {"data": [], "error": "Failed to extract data: " + ", ".join(error_logs), **extra}
+
+    # Apply flattening logic to the combined results
+    with span("flatten", model=model_name):
+        processed_data = flatten_data(all_extracted_data)
+    # Chỉ cache khi tất cả các trang đều thành công (và không trang nào phải dùng model dự phòng)
+    await store_cached_result(cache_key, mode, processed_data, complete=not error_logs)
+    return {"data": processed_data, **extra}
+
+def served_by_preferred(model_name):
+    """True khi mọi lời gọi của request hiện tại đều do model ưu tiên của mode phục vụ"""
+    served = SERVED_MODELS.get()
+    return not served or served == [model_name]
+
+def check_deadline(deadline, slo):
+    """Deadline (giây) hoặc SLO tier từ form -> deadline tuyệt đối gắn vào context của request"""
+    if slo is not None and slo not in SLO_TIERS:
+        raise HTTPException(status_code=400, detail=f"Unknown SLO tier '{slo}'. Use one of {list(SLO_TIERS)}.")
+    if deadline is not None and deadline <= 0:
+        raise HTTPException(status_code=400, detail="deadline must be a positive number of seconds.")
+    seconds = deadline if deadline is not None else SLO_TIERS.get(slo)
+    absolute = None if seconds is None else time.monotonic() + seconds
+    CURRENT_DEADLINE.set(absolute)
+    return absolute
+
+def check_encoding_profile(encoding):
+    """Validate profile từ form (None = ENCODING_PROFILE) và gắn vào context của request"""
+    profile = encoding or ENCODING_PROFILE
+    if profile not in ENCODING_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown encoding profile '{profile}'. Use one of {list(ENCODING_PROFILES)}.")
+    CURRENT_PROFILE.set(profile)
+    return profile
+
 @app.post("/extract")
 async def extract_document(
     file: UploadFile = File(...), 
-    mode: str = Form("standard")
+    mode: str = Form("standard"),
+    encoding: str = Form(None),
+    deadline: float = Form(None),
+    slo: str = Form(None)
 ):
+    profile = check_encoding_profile(encoding)
+    absolute_deadline = check_deadline(deadline, slo)
     print(f"\n--> Receiving file: {file.filename} | Mode: {mode}")
-    
-    try:
-        file_bytes = await file.read()
-        is_material_mode = (mode == "material_list")
-        
-        # --- CONFIG ROUTING ---
-        system_prompt = MATERIAL_LIST_PROMPT if is_material_mode else STANDARD_PROMPT
-        target_url = GEMINI_URL_PRO if is_material_mode else GEMINI_URL_FLASH
-        target_model_name = "gemini-2.5-pro" if is_material_mode else "gemini-2.5-flash-lite"
-        
-        image_parts = []
 
-        # --- PREPARE PAYLOAD ---
-        if is_material_mode and file.filename.lower().endswith(".pdf"):
-            # PRO MODE: Pass Raw PDF Bytes directly for reasoning
-            print(f"   Using {target_model_name} with direct PDF upload.")
-            encoded_pdf = base64.b64encode(file_bytes).decode("utf-8")
-            image_parts.append({
-                "inline_data": {
-                    "mime_type": "application/pdf",
-                    "data": encoded_pdf
-                }
-            })
-        elif file.filename.lower().endswith(".pdf"):
-            # STANDARD MODE: Convert to Images
-            print(f"   Converting PDF to images for {target_model_name}...")
-            images_bytes_list = pdf_to_images(file_bytes)
-            
-            for img_bytes in images_bytes_list:
-                try:
-                    image = Image.open(io.BytesIO(img_bytes))
-                    MAX_SIZE = 3072 
-                    if max(image.size) > MAX_SIZE:
-                        image.thumbnail((MAX_SIZE, MAX_SIZE))
-                    
-                    buffered = io.BytesIO()
-                    if image.mode in ("RGBA", "P"): image = image.convert("RGB")
-                    image.save(buffered, format="JPEG", quality=85)
-                    
-                    encoded_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
-                    image_parts.append({
-                        "inline_data": {
-                            "mime_type": "image/jpeg",
-                            "data": encoded_image
-                        }
-                    })
-                except Exception as img_err:
-                    pass
-        else:
-            # NORMAL IMAGE HANDLING
+    upload = await spool_upload(file)
+    try:
+        async with UPLOAD_BUDGET.reserve(upload.size, INFLIGHT_QUEUE_SECONDS):
             try:
-                image = Image.open(io.BytesIO(file_bytes))
-                MAX_SIZE = 3072 
-                if max(image.size) > MAX_SIZE:
-                    image.thumbnail((MAX_SIZE, MAX_SIZE))
-                    
-                buffered = io.BytesIO()
-                if image.mode in ("RGBA", "P"): image = image.convert("RGB")
-                image.save(buffered, format="JPEG", quality=85)
-                encoded_image = base64.b64encode(buffered.getvalue()).decode("utf-8")
-                image_parts.append({
-                    "inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": encoded_image
-                    }
-                })
+                return await run_extraction(upload, file.filename, mode, uuid.uuid4().hex, profile, absolute_deadline)
             except Exception as e:
-                # Fallback to direct bytes
-                encoded_image = base64.b64encode(file_bytes).decode("utf-8")
-                mime = "image/png" if file.filename.lower().endswith(".png") else "image/jpeg"
-                image_parts.append({"inline_data": {"mime_type": mime, "data": encoded_image}})
-
-        # --- CALL GOOGLE API & PROCESS RESULT ---
-        if is_material_mode:
-            # MATERIAL LIST (PRO MODEL) - One big call (Giữ nguyên, không thay đổi)
-            payload = {
-                "contents": [{
-                    "parts": [{"text": system_prompt}] + image_parts
-                }],
-                "generationConfig": {
-                    "temperature": 0.1,
-                    "response_mime_type": "text/plain"
-                }
-            }
+                print(f"Server Error: {str(e)}")
+                raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await asyncio.to_thread(upload.close)
 
-            print(f"--> Calling {target_model_name}...")
-            response = requests.post(target_url, json=payload)
+@app.post("/jobs")
+async def create_job(
+    files: List[UploadFile] = File(...),
+    mode: str = Form("standard")
+):
+    uploads = []
+    try:
+        for file in files:
+            uploads.append((file.filename, await spool_upload(file, JOB_STORE.spool_dir)))
+        job_id = await asyncio.to_thread(JOB_STORE.create, mode, uploads)
+    except BaseException:
+        for _, upload in uploads:
+            upload.close()
+        raise
+    if _job_wakeup is not None:
+        _job_wakeup.set()
+    print(f"\n--> Queued job {job_id}: {len(uploads)} files | Mode: {mode}")
+    return {"job_id": job_id, "status": "queued", "total_files": len(uploads)}
 
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail=f"Gemini API Error: {response.text}")
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(JOB_STORE.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
 
-            result_json = response.json()
-            
-            try:
-                raw_response = result_json["candidates"][0]["content"]["parts"][0]["text"]
-            except (KeyError, IndexError):
-                 raise HTTPException(status_code=500, detail="Gemini returned unexpected structure.")
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = await asyncio.to_thread(JOB_STORE.get, job_id, True)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']} ({job['completed_files']}/{job['total_files']} files).")
+    return job
+
+@app.get("/jobs/{job_id}/export")
+async def export_job_result(job_id: str, format: str = "csv"):
+    """Kết quả job dưới dạng CSV / XLSX: đọc và ghi từng file một, theo thứ tự file của job.
+    File bị lỗi được ghi thành dòng "LỖI"; job mà mọi file đều lỗi trả về 502"""
+    check_export_format(format)
+    job = await asyncio.to_thread(JOB_STORE.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']} ({job['completed_files']}/{job['total_files']} files).")
+    if job["files"] and all(f["status"] == "failed" for f in job["files"]):
+        errors = [f"{f['filename']}: {f['error']}" for f in job["files"]]
+        raise HTTPException(status_code=502, detail="Failed to extract data: " + ", ".join(errors))
+    mode = job["mode"]
+    exporter = new_export(format, mode)
+
+    async def row_batches():
+        stt = 1
+        for file_index in range(job["total_files"]):
+            entry = await asyncio.to_thread(JOB_STORE.file_result, job_id, file_index)
+            if entry is None:
+                continue
+            filename, status, result, error = entry
+            if status != "done" or result is None:
+                yield [export_error_row(mode, filename, error or f"File {status}.")]
+                continue
+            if mode == "material_list":
+                rows = material_export_rows(result.get("data") or [], filename)
+            else:
+                rows = standard_export_rows(result.get("data") or [], filename, stt)
+                stt += len(rows)
+            yield rows
+
+    return export_response(iter_export(exporter, format, "job", row_batches()), exporter, f"job_{job_id}")
+
+def ndjson_event(event):
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+async def merge_row_previews(source):
+    """Chạy NDJSON generator `source` trong task riêng và chen các event "rows" (preview từ
+    streamGenerateContent, qua ROW_PREVIEW) vào giữa các event của nó ngay khi có"""
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        ROW_PREVIEW.set(lambda event: queue.put_nowait(ndjson_event(event)))
+        try:
+            async for line in source:
+                queue.put_nowait(line)
+        finally:
+            queue.put_nowait(finished)
 
-            print(f"--> Response received ({len(raw_response)} chars).")
-            processed_data = parse_material_csv(raw_response)
-            return {"data": processed_data}
+    task = asyncio.create_task(pump())
+    try:
+        while (line := await queue.get()) is not finished:
+            yield line
+        await task
+    finally:
+        task.cancel()
+
+@app.post("/extract/stream")
+async def extract_document_stream(
+    file: UploadFile = File(...),
+    mode: str = Form("standard"),
+    encoding: str = Form(None),
+    deadline: float = Form(None),
+    slo: str = Form(None)
+):
+    """Giống /extract nhưng trả về NDJSON: một event cho mỗi trang ngay khi trang đó xong,
+    event lỗi theo từng trang và một event "summary" ở cuối. Khi GEMINI_STREAMING bật có thêm event
+    "rows" (preview trong lúc model còn sinh; event "page" / "groups" sau đó mới là kết quả chính thức)"""
+    print(f"\n--> Receiving file (stream): {file.filename} | Mode: {mode}")
+    doc_id = uuid.uuid4().hex
+    filename = file.filename
+
+    profile = check_encoding_profile(encoding)
+    absolute_deadline = check_deadline(deadline, slo)
+    upload, release = await admit_upload(file)
+
+    async def events():
+        served = bind_extraction_context(upload, mode, profile, absolute_deadline)
+        error_logs = []
+        skipped_pages = []
+        total_rows = 0
+        cached = None
+        try:
+            cache_key, cached = await lookup_cached_result(upload, mode)
+            if cached is not None:
+                yield ndjson_event({"event": "cached", "data": cached})
+                total_rows = len(cached)
+
+            elif mode == "material_list":
+                processed_data = await extract_material_list(upload, filename, doc_id)
+                await store_cached_result(cache_key, mode, processed_data)
+                total_rows = sum(len(group["data"]) for group in processed_data)
+                yield ndjson_event({"event": "groups", "data": processed_data})
+
+            else:
+                page_results = {}
+                async with aclosing(iter_standard_pages(upload, filename, doc_id)) as pages:
+                    async for index, page_data, err, skip in pages:
+                        if skip:
+                            skipped_pages.append(skip)
+                            yield ndjson_event({"event": "skipped", **skip})
+                            if page_data is None:
+                                continue
+                        if err:
+                            error_logs.append(err)
+                            print(f"    {err}")
+                            yield ndjson_event({"event": "error", "page": index + 1, "error": err})
+                            continue
+                        page_results[index] = page_data or []
+                        rows = flatten_data(page_data or [])
+                        total_rows += len(rows)
+                        yield ndjson_event({"event": "page", "page": index + 1, "data": rows})
+
+                if cache_key and not error_logs:
+                    ordered = [item for index in sorted(page_results) for item in page_results[index]]
+                    await store_cached_result(cache_key, mode, flatten_data(ordered))
+
+        except HTTPException as e:
+            error_logs.append(str(e.detail))
+            yield ndjson_event({"event": "error", "page": None, "error": str(e.detail)})
+        except Exception as e:
+            print(f"Server Error: {str(e)}")
+            error_logs.append(str(e))
+            yield ndjson_event({"event": "error", "page": None, "error": str(e)})
+        finally:
+            release()
+
+        yield ndjson_event({
+            "event": "summary",
+            "rows": total_rows,
+            "errors": error_logs,
+            "skipped_pages": skipped_pages,
+            "cached": cached is not None,
+            "served_by": served,
+        })
+
+    body = merge_row_previews(events()) if GEMINI_STREAMING else events()
+    return StreamingResponse(body, media_type="application/x-ndjson", background=BackgroundTask(release))
+
+@app.post("/extract/export")
+async def export_document(
+    file: UploadFile = File(...),
+    mode: str = Form("standard"),
+    format: str = Form("csv"),
+    encoding: str = Form(None),
+    deadline: float = Form(None),
+    slo: str = Form(None)
+):
+    """Trích xuất (hoặc lấy từ result cache) và trả về file CSV / XLSX. Standard Mode ghi từng trang ngay khi
+    tới lượt theo thứ tự trang; Material List ghi theo thứ tự nhóm (Tên bảng, Mã code).
+    Lỗi trước khi có dữ liệu (Material List lỗi, mọi trang đều lỗi) trả về mã lỗi HTTP thật; sau khi file đã
+    bắt đầu được gửi, trang lỗi được ghi thành dòng "LỖI" trong file"""
+    print(f"\n--> Receiving file (export {format}): {file.filename} | Mode: {mode}")
+    check_export_format(format)
+    doc_id = uuid.uuid4().hex
+    filename = file.filename
 
+    profile = check_encoding_profile(encoding)
+    absolute_deadline = check_deadline(deadline, slo)
+    upload, release = await admit_upload(file)
+
+    # Trước khi trả header: lấy từ cache / chạy Material List / chạy tới trang thành công đầu tiên
+    bind_extraction_context(upload, mode, profile, absolute_deadline)
+    pages = None
+    head = []  # Standard Mode: (rows, error) các trang đã xong trước khi trả header, theo thứ tự trang
+    try:
+        cache_key, cached = await lookup_cached_result(upload, mode)
+        if cached is not None:
+            print(f"--> Cache hit for {filename}.")
+            ready_rows = (material_export_rows(cached, filename) if mode == "material_list"
+                          else standard_export_rows(cached, filename))
+        elif mode == "material_list":
+            processed_data = await extract_material_list(upload, filename, doc_id)
+            await store_cached_result(cache_key, mode, processed_data)
+            ready_rows = material_export_rows(processed_data, filename)
         else:
-            # STANDARD MODE (FLASH LITE) - Cập nhật xử lý song song (Concurrency)
-            print(f"--> Calling {target_model_name} concurrently for {len(image_parts)} pages...")
-            all_extracted_data = []
-            error_logs = []
-
-            # Hàm con để xử lý từng trang một cách riêng biệt
-            def process_single_page(img_part, index):
-                payload = {
-                    "contents": [{
-                        "parts": [{"text": system_prompt}, img_part]
-                    }],
-                    "generationConfig": {
-                        "temperature": 0.1,
-                        "response_mime_type": "application/json"
-                    }
-                }
-                try:
-                    response = requests.post(target_url, json=payload)
-                    if response.status_code != 200:
-                        return None, f"Page {index+1} API Error: {response.text}"
-                    
-                    result_json = response.json()
-                    raw_response = result_json["candidates"][0]["content"]["parts"][0]["text"]
-                    clean_text = raw_response.replace("```json", "").replace("```", "").strip()
-                    page_data = json.loads(clean_text)
-                    
-                    if isinstance(page_data, dict):
-                        page_data = [page_data]
-                    return page_data, None
-                except Exception as e:
-                    return None, f"Page {index+1} JSON Parse Error: {str(e)}"
-
-            # Sử dụng ThreadPoolExecutor để chạy song song tối đa 3-5 request cùng lúc
-            # Dùng executor.map để vẫn GIỮ NGUYÊN THỨ TỰ (từ trang 1 đến trang cuối) khi trả về frontend
-            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-                # Tạo list params: tuple(image_part, index)
-                params = [(img, idx) for idx, img in enumerate(image_parts)]
-                
-                # Gọi API song song
-                results = executor.map(lambda p: process_single_page(p[0], p[1]), params)
-                
-                # Gom kết quả theo đúng thứ tự
-                for page_data, err in results:
-                    if err:
-                        error_logs.append(err)
-                        print(f"    {err}")
-                    elif page_data:
-                        all_extracted_data.extend(page_data)
+            ready_rows = None
+            pages = iter_pages_in_order(upload, filename, doc_id)
+            async for _, rows, err in pages:
+                head.append((rows, err))
+                if not err:
+                    break
+            else:
+                errors = [err for _, err in head]
+                if errors:
+                    raise HTTPException(status_code=502, detail="Failed to extract data: " + ", ".join(errors))
+    except BaseException as e:
+        if pages is not None:
+            await pages.aclose()
+        release()
+        if isinstance(e, Exception) and not isinstance(e, HTTPException):
+            print(f"Server Error: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+        raise
 
-            if not all_extracted_data and error_logs:
-                return {"data": [], "error": "Failed to extract data: " + ", ".join(error_logs)}
+    exporter = new_export(format, mode)
 
-            # Apply flattening logic to the combined results
-            processed_data = flatten_data(all_extracted_data)
-            return {"data": processed_data}
+    async def row_batches():
+        try:
+            if ready_rows is not None:
+                yield ready_rows
+                return
 
-    except Exception as e:
-        print(f"Server Error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+            # Chỉ giữ dòng khi cần ghi result cache, tối đa EXPORT_CACHE_MAX_ROWS (file lớn bỏ qua cache)
+            collected = [] if cache_key else None
+            failed = False
+            stt = 1
+
+            async def remaining():
+                for rows, err in head:
+                    yield rows, err
+                async for _, rows, err in pages:
+                    yield rows, err
+
+            async with aclosing(pages):
+                async for rows, err in remaining():
+                    if err:
+                        failed = True
+                        print(f"    {err}")
+                        yield [export_error_row(mode, filename, err)]
+                        continue
+                    if collected is not None:
+                        collected.extend(rows)
+                        if len(collected) > EXPORT_CACHE_MAX_ROWS:
+                            collected = None
+                    yield standard_export_rows(rows, filename, stt)
+                    stt += len(rows)
+            await store_cached_result(cache_key, mode, collected, complete=collected is not None and not failed)
+        except HTTPException as e:
+            # Header đã được gửi: ghi lỗi vào file (file vẫn hợp lệ) thay vì cắt ngang response
+            yield [export_error_row(mode, filename, str(e.detail))]
+        except Exception as e:
+            print(f"Server Error: {str(e)}")
+            yield [export_error_row(mode, filename, str(e))]
+        finally:
+            release()
+
+    return export_response(iter_export(exporter, format, "extract", row_batches()), exporter, filename, release)
 
 if __name__ == "__main__":
     print(f"Starting Gemini Proxy Server on port 8000")
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# Import server without touching the working directory (cache / job databases go to a temp dir)
+_workdir = tempfile.mkdtemp(prefix="extractor-tests-")
+os.environ.setdefault("API_KEY", "test")
+os.environ.setdefault("CACHE_ENABLED", "0")
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(_workdir, "jobs.sqlite3"))
+os.environ.setdefault("JOBS_SPOOL_DIR", os.path.join(_workdir, "job_uploads"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,112 @@
+import csv
+import io
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+
+@pytest.mark.parametrize("text, expected", [
+    ("3 193", 3193),
+    ("20,5", 20.5),
+    ("12", 12),
+    ("abc", "abc"),
+    # Giá trị không hữu hạn giữ nguyên text
+    ("inf", "inf"),
+    ("-Infinity", "-Infinity"),
+    ("nan", "nan"),
+])
+def test_export_number(text, expected):
+    assert server.export_number(text) == expected
+
+def sheet_xml(exporter):
+    data = exporter.close()
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        return archive.read("xl/worksheets/sheet1.xml").decode("utf-8")
+
+def test_xlsx_writes_non_finite_floats_as_text():
+    exporter = server.XlsxExport(["a", "b", "c"])
+    exporter.write_row([float("inf"), float("nan"), 1.5])
+    xml = sheet_xml(exporter)
+    assert "<v>inf</v>" not in xml and "<v>nan</v>" not in xml
+    assert '<t xml:space="preserve">inf</t>' in xml
+    assert '<t xml:space="preserve">nan</t>' in xml
+    assert "<c><v>1.5</v></c>" in xml
+
+def export_csv(response):
+    return list(csv.reader(io.StringIO(response.content.decode("utf-8-sig"))))
+
+def fake_pages(results):
+    async def pages(upload, filename, doc_id):
+        for index, (rows, err) in enumerate(results):
+            yield index, rows, err
+    return pages
+
+def post_export(data):
+    client = TestClient(server.app)
+    return client.post("/extract/export", files={"file": ("a.pdf", b"%PDF")}, data=data)
+
+def test_export_error_row_marks_the_failed_part():
+    row = server.export_error_row("standard", "a.pdf", "Page 2: timeout")
+    keys = [key for key, _ in server.STANDARD_EXPORT_COLUMNS]
+    assert len(row) == len(keys)
+    assert dict(zip(keys, row)) == {
+        **dict.fromkeys(keys), "source_file": "a.pdf", "doc_type": "LỖI", "description": "Page 2: timeout",
+    }
+    row = server.export_error_row("material_list", "a.pdf", "Pro failed")
+    assert row[:2] == ["a.pdf", "LỖI"] and "Pro failed" in row
+
+def test_export_fails_with_status_when_every_page_fails(monkeypatch):
+    monkeypatch.setattr(server, "iter_pages_in_order", fake_pages([(None, "Page 1: bad"), (None, "Page 2: bad")]))
+    response = post_export({"mode": "standard"})
+    assert response.status_code == 502
+    assert "Page 1: bad" in response.json()["detail"]
+
+def test_export_writes_error_rows_for_failed_pages(monkeypatch):
+    pages = [(None, "Page 1: bad"), ([{"description": "x"}], None), (None, "Page 3: bad")]
+    monkeypatch.setattr(server, "iter_pages_in_order", fake_pages(pages))
+    response = post_export({"mode": "standard"})
+    assert response.status_code == 200
+    rows = export_csv(response)[1:]
+    doc_type = [key for key, _ in server.STANDARD_EXPORT_COLUMNS].index("doc_type")
+    assert [row[doc_type] for row in rows] == ["LỖI", "", "LỖI"]
+    assert "Page 3: bad" in rows[2]
+
+def test_export_material_failure_is_a_real_error_status(monkeypatch):
+    async def failing(upload, filename, doc_id):
+        raise HTTPException(status_code=502, detail="Pro failed")
+    monkeypatch.setattr(server, "extract_material_list", failing)
+    response = post_export({"mode": "material_list"})
+    assert response.status_code == 502 and response.json()["detail"] == "Pro failed"
+
+def finished_job(tmp_path, monkeypatch, statuses):
+    store = server.JobStore(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "spool"))
+    monkeypatch.setattr(server, "JOB_STORE", store)
+    uploads = []
+    for index in range(len(statuses)):
+        path = tmp_path / f"upload_{index}.pdf"
+        path.write_bytes(b"%PDF")
+        uploads.append((f"{index}.pdf", server.SpooledUpload.from_path(str(path))))
+    job_id = store.create("standard", uploads)
+    for status in statuses:
+        _, file_index, *_ = store.claim_next()
+        if status == "done":
+            store.finish_file(job_id, file_index, "done", {"data": [{"description": "x"}]})
+        else:
+            store.finish_file(job_id, file_index, "failed", error="Pro failed")
+    return job_id
+
+def test_job_export_keeps_failed_files_as_error_rows(tmp_path, monkeypatch):
+    job_id = finished_job(tmp_path, monkeypatch, ["done", "failed"])
+    response = TestClient(server.app).get(f"/jobs/{job_id}/export")
+    assert response.status_code == 200
+    rows = export_csv(response)[1:]
+    assert len(rows) == 2
+    assert rows[1][1:3] == ["1.pdf", "LỖI"] and "Pro failed" in rows[1]
+
+def test_job_export_fails_when_every_file_failed(tmp_path, monkeypatch):
+    job_id = finished_job(tmp_path, monkeypatch, ["failed", "failed"])
+    response = TestClient(server.app).get(f"/jobs/{job_id}/export")
+    assert response.status_code == 502
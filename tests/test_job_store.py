@@ -0,0 +1,51 @@
+import os
+import threading
+
+import server
+
+def make_store(tmp_path):
+    return server.JobStore(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "spool"))
+
+def queue_files(store, tmp_path, count):
+    uploads = []
+    for index in range(count):
+        path = tmp_path / f"upload_{index}.pdf"
+        path.write_bytes(b"%PDF")
+        uploads.append((f"{index}.pdf", server.SpooledUpload.from_path(str(path))))
+    return store.create("standard", uploads)
+
+def test_two_processes_never_claim_the_same_file(tmp_path):
+    first, second = make_store(tmp_path), make_store(tmp_path)
+    queue_files(first, tmp_path, 40)
+    claims = {first.owner: [], second.owner: []}
+
+    def drain(store):
+        while (claimed := store.claim_next()) is not None:
+            claims[store.owner].append(claimed[1])
+
+    threads = [threading.Thread(target=drain, args=(store,)) for store in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed = claims[first.owner] + claims[second.owner]
+    assert sorted(claimed) == list(range(40))
+
+def test_only_stale_claims_are_requeued(tmp_path):
+    alive, restarted = make_store(tmp_path), make_store(tmp_path)
+    job_id = queue_files(alive, tmp_path, 1)
+    assert alive.claim_next()[:2] == (job_id, 0)
+
+    # Process mới khởi động không được lấy lại file process khác vẫn đang xử lý
+    assert restarted.requeue_stale(60) == 0
+    assert restarted.claim_next() is None
+
+    # Hết heartbeat -> requeue; kết quả muộn của owner cũ bị bỏ
+    assert restarted.requeue_stale(-1) == 1
+    claimed = restarted.claim_next()
+    assert claimed[:2] == (job_id, 0)
+    assert alive.finish_file(job_id, 0, "done", {"data": []}) is False
+    assert restarted.finish_file(job_id, 0, "done", {"data": []}) is True
+    job = restarted.get(job_id)
+    assert job["status"] == "done" and job["completed_files"] == 1
+    assert os.path.exists(claimed[3])
@@ -0,0 +1,25 @@
+import pytest
+
+import server
+
+def parse(chunks):
+    stream = server.JsonArrayStream()
+    items = []
+    for chunk in chunks:
+        items += stream.feed(chunk)
+    return items + stream.close()
+
+@pytest.mark.parametrize("chunks", [
+    ['[{"a": 1}, {"a": 2}]'],
+    ['```json\n[{"a": 1}, ', '{"a": 2}]\n```'],
+    # Fence bị cắt giữa các chunk SSE
+    ["`", '``json\n[{"a": 1}, {"a": 2}]'],
+    ["\n``", '`\n[{"a": 1}, {"a": 2}]'],
+    ["``", "`js", 'on\n[{"a": 1},', ' {"a": 2}]'],
+])
+def test_split_chunks(chunks):
+    assert parse(chunks) == [{"a": 1}, {"a": 2}]
+
+def test_rejects_text_before_array():
+    with pytest.raises(server.MalformedOutputError):
+        parse(["`x", "[]"])
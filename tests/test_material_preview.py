@@ -0,0 +1,60 @@
+import server
+
+HEADER = "Tên bảng|Mã code|STT|Tên vật tư|Quy cách|ĐVT|Định mức|Thực lĩnh|Chênh lệch|Ghi chú\n"
+
+def feed(preview, index, text):
+    parser = preview.parser(index)()
+    rows = parser.feed(text)
+    rows += parser.close()
+    preview.rows(index, rows)
+
+def test_later_chunk_waits_for_previous_group():
+    events = []
+    preview = server.MaterialChunkPreview(events.append)
+
+    # Chunk 1 xong trước: dòng tiếp nối bảng của chunk 0 chưa được preview
+    feed(preview, 1, HEADER + "||3|c||kg|1|1||\nBẢNG B||1|d||kg|2|2||\n")
+    preview.finished(1)
+    assert events == []
+
+    feed(preview, 0, HEADER + "BẢNG A|27B1|1|a||kg|1|1||\n||2|b||kg|1|1||\n")
+    assert [(e["chunk"], e["list_name"], e["order_number"]) for e in events] == [(0, "BẢNG A", "27B1")]
+    preview.finished(0)
+
+    assert [(e["chunk"], e["list_name"], e["order_number"], len(e["data"])) for e in events] == [
+        (0, "BẢNG A", "27B1", 2),
+        (1, "BẢNG A", "27B1", 1),
+        (1, "BẢNG B", "27B1", 1),
+    ]
+
+def test_preview_matches_stitched_parse():
+    chunks = [
+        HEADER + "BẢNG A|27B1|1|a||kg|1|1||\n",
+        HEADER + "||2|b||kg|1|1||\n",
+        HEADER + "|27B2|1|c||kg|1|1||\n",
+    ]
+    events = []
+    preview = server.MaterialChunkPreview(events.append)
+    for index in (2, 1, 0):
+        feed(preview, index, chunks[index])
+        preview.finished(index)
+    previewed = [(e["list_name"], e["order_number"], row["Tên vật tư"])
+                 for e in sorted(events, key=lambda e: e["chunk"]) for row in e["data"]]
+    parsed = [(g["list_name"], g["order_number"], row["Tên vật tư"])
+              for g in server.parse_material_csv(server.stitch_material_csv(chunks)) for row in g["data"]]
+    assert previewed == parsed
+
+def test_retried_chunk_replaces_previous_rows():
+    events = []
+    preview = server.MaterialChunkPreview(events.append)
+    first = preview.parser(0)()
+    preview.rows(0, first.feed(HEADER + "BẢNG A|27B1|1|a||kg|1|1||\n"))
+    # Hedge: parser được tạo nhưng không gửi preview
+    preview.parser(0)()
+    retry = preview.parser(0)()
+    preview.rows(0, retry.feed(HEADER + "BẢNG A|27B1|1|a||kg|1|1||\n||2|b||kg|1|1||\n"))
+    # Dòng đến muộn của lần gọi cũ bị bỏ qua
+    preview.rows(0, first.feed("||2|b||kg|1|1||\n"))
+    preview.finished(0)
+    assert [e["event"] for e in events] == ["rows", "rows_reset", "rows"]
+    assert [row["Tên vật tư"] for row in events[-1]["data"]] == ["a", "b"]
@@ -0,0 +1,84 @@
+import pytest
+
+import server
+
+def codes(prefix, first, last, width=3):
+    return [f"{prefix}{n:0{width}d}" for n in range(first, last + 1)]
+
+@pytest.mark.parametrize("text, expected", [
+    # Prefix được mang sang các số phía sau
+    ("25B827, 828, 621", ["25B827", "25B828", "25B621"]),
+    ("22A023", ["22A023"]),
+    # Range với các kiểu dấu nối
+    ("25B834-838", codes("25B", 834, 838)),
+    ("25B834 - 838", codes("25B", 834, 838)),
+    ("25B834-->838", codes("25B", 834, 838)),
+    ("25B834->838", codes("25B", 834, 838)),
+    ("25B834 => 838", codes("25B", 834, 838)),
+    ("25B834 → 838", codes("25B", 834, 838)),
+    ("25B834–838", codes("25B", 834, 838)),
+    ("25B834~838", codes("25B", 834, 838)),
+    ("25B834 đến 838", codes("25B", 834, 838)),
+    ("25B834-25B838", codes("25B", 834, 838)),
+    # Số cuối viết tắt
+    ("25B834-38", codes("25B", 834, 838)),
+    ("25B834-->38", codes("25B", 834, 838)),
+    # Prefix tách rời
+    ("26D 486-->489, 495", codes("26D", 486, 489) + ["26D495"]),
+    # Mã có prefix riêng không bị đệm chữ số từ mã trước
+    ("25B827, 25C10", ["25B827", "25C10"]),
+    ("25B827 và 828; 829", ["25B827", "25B828", "25B829"]),
+    (None, []),
+    ("", []),
+])
+def test_expand(text, expected):
+    assert server.expand_order_numbers(text) == expected
+
+def test_expand_list_input():
+    assert server.expand_order_numbers(["25B834", "835", None]) == ["25B834", "25B835"]
+    assert server.expand_order_numbers(["25B834-836"]) == codes("25B", 834, 836)
+
+@pytest.mark.parametrize("text", [
+    "25B838-834",        # descending
+    "25B10-26C12",       # prefix mismatch
+    "25B1-999",          # span > ORDER_RANGE_MAX_SPAN
+    "25B834-838-840",    # nhiều dấu nối: không được bịa ra mã "25B834-838"
+])
+def test_rejected_range_keeps_text(text):
+    assert server.expand_order_numbers(text) == [text]
+
+def test_total_cap(monkeypatch):
+    monkeypatch.setattr(server, "ORDER_NUMBERS_MAX", 10)
+    assert server.expand_order_numbers("25B100-105, 25B200-205") == codes("25B", 100, 105) + ["25B200-205"]
+
+@pytest.mark.parametrize("text, expected", [
+    ("No. 12", ["12"]),
+    ("S/N 1234-1236", ["1234", "1235", "1236"]),
+    ("Số: 25B834, 835", ["25B834", "25B835"]),
+    ("Không có", ["Không có"]),
+])
+def test_labels_are_not_codes(text, expected):
+    assert server.expand_order_numbers(text) == expected
+
+@pytest.mark.parametrize("value, expected", [
+    # Prefix chữ cái đứng trước số được giữ lại
+    ("CT 01, 02", ["CT 01", "CT 02"]),
+    (["MBA 123"], ["MBA 123"]),
+    ("CT 01-03", ["CT 01", "CT 02", "CT 03"]),
+    # Chỉ số cuối của range được mượn chữ số đầu; mã trong list thì không
+    (["1234", "56"], ["1234", "56"]),
+    ("25B827, 5", ["25B827", "5"]),
+    ("1234-56", [str(n) for n in range(1234, 1257)]),
+])
+def test_no_guessing_outside_ranges(value, expected):
+    assert server.expand_order_numbers(value) == expected
+
+def test_flatten_keeps_model_arrays(monkeypatch):
+    monkeypatch.setattr(server, "ORDER_NUMBER_EXPANSION", "model")
+    rows = server.flatten_data([{"description": "Sứ", "order_numbers": ["1234", "56", "CT 01"]}])
+    assert [row["order_numbers"] for row in rows] == ["1234", "56", "CT 01"]
+
+def test_flatten_count_match_ignores_labels():
+    rows = server.flatten_data([{"description": "Sứ", "order_numbers": "S/N 1234-1236", "quantity_actual": 3}])
+    assert [row["order_numbers"] for row in rows] == ["1234", "1235", "1236"]
+    assert all(row["quantity_actual"] == 1 for row in rows)
@@ -0,0 +1,33 @@
+import sqlite3
+
+import server
+
+class BrokenDb:
+    """Kết nối SQLite luôn báo lỗi (DB bị khóa / hỏng / đầy)"""
+
+    def execute(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+    def commit(self):
+        raise sqlite3.OperationalError("database is locked")
+
+    def rollback(self):
+        pass
+
+def test_disk_round_trip(tmp_path):
+    db_path = str(tmp_path / "cache.sqlite3")
+    server.ResultCache(1024, db_path).put("k", [{"a": 1}])
+    cache = server.ResultCache(1024, db_path)
+    assert cache.get("k") == [{"a": 1}]
+    assert cache.stats["disk_hits"] == 1
+
+def test_disk_errors_are_best_effort(tmp_path):
+    cache = server.ResultCache(1024, str(tmp_path / "cache.sqlite3"))
+    cache._db = BrokenDb()
+    assert cache.get("missing") is None
+    cache.put("k", [1, 2])
+    # Tầng RAM vẫn hoạt động
+    assert cache.get("k") == [1, 2]
+    cache.clear()
+    assert cache.stats["misses"] == 1
+    assert cache.stats["disk_errors"] == 3
@@ -0,0 +1,46 @@
+import asyncio
+
+import server
+
+def test_half_open_allows_a_single_probe(monkeypatch):
+    flash, pro = server.GEMINI_MODEL_FLASH, server.GEMINI_MODEL_PRO
+    router = server.ModelRouter(
+        {flash: server.GEMINI_URL_FLASH, pro: server.GEMINI_URL_PRO}, {flash: pro, pro: flash}
+    )
+    monkeypatch.setattr(server, "MODEL_ROUTER", router)
+    monkeypatch.setattr(server, "GEMINI_MAX_RETRIES", 0)
+    calls = []
+
+    async def fake_post(url, payload, timeout=None):
+        model = flash if url == server.GEMINI_URL_FLASH else pro
+        calls.append(model)
+        await asyncio.sleep(0.05)
+        return "[]"
+
+    monkeypatch.setattr(server, "_post_generate", fake_post)
+
+    breaker = router.breakers[flash]
+    breaker._trip()
+    breaker.open_until = 0.0  # cooldown đã hết -> half-open
+
+    async def burst(count):
+        return await asyncio.gather(*(
+            server.routed_generate(server.GEMINI_URL_FLASH, {}, flash) for _ in range(count)
+        ))
+
+    served = [model for _, model in asyncio.run(burst(5))]
+    assert served.count(flash) == 1 and served.count(pro) == 4
+    assert breaker.state() == "closed" and not breaker.probing
+
+    calls.clear()
+    served = [model for _, model in asyncio.run(burst(3))]
+    assert served == [flash] * 3
+
+def test_failed_probe_reopens(monkeypatch):
+    breaker = server.CircuitBreaker(10, 0.5, 2, 30)
+    breaker._trip()
+    breaker.open_until = 0.0
+    assert breaker.acquire() and not breaker.acquire()
+    breaker.record(False)
+    breaker.release()
+    assert breaker.state() == "open" and not breaker.available()
@@ -0,0 +1,32 @@
+import fitz
+import pytest
+
+import render
+import server
+
+def render_features(draw=None):
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    if draw is not None:
+        draw(page)
+    return render.page_features(page.get_pixmap(dpi=render.RENDER_DPI))
+
+def test_empty_page_is_blank():
+    assert server.is_blank_page(render_features())
+
+def test_single_speck_is_blank():
+    assert server.is_blank_page(render_features(lambda page: page.insert_text((72, 72), "x", fontsize=8)))
+
+@pytest.mark.parametrize("draw", [
+    # Trang chỉ có một dòng tiêu đề (ink_ratio ~0.0015, từng bị bỏ qua nhầm)
+    lambda page: page.insert_text((180, 60), "PHIEU NHAP KHO", fontsize=18),
+    lambda page: page.insert_text((72, 400), "So: NK00123 - Ngay 14 thang 07 nam 2022", fontsize=9),
+])
+def test_sparse_page_is_kept(draw):
+    assert not server.is_blank_page(render_features(draw))
+
+def test_one_row_table_is_kept():
+    def draw(page):
+        page.draw_rect(fitz.Rect(40, 120, 555, 144))
+        page.insert_text((44, 136), "1  Vat tu 123 25B834  Cai  2", fontsize=9)
+    assert not server.is_blank_page(render_features(draw))